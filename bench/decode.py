@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""
+    Micro-benchmark for the JSON lines decoding stage: decoding a line and
+    formatting the fields of the template, as done for every input line of
+    a virtual user with a format. For comparison, "naive" decodes and
+    formats the whole object with a format string given as is.
+
+    Run from the repository root:
+        python bench/decode.py [lines]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from irclogd.decode import JsonTemplate, json
+
+lines = {
+    'small' : [ '{{"level":"{}","service":"api{}","msg":"request {} done"}}'.format(('info', 'warn', 'error')[i % 3], i % 10, i) for i in xrange(1000) ],
+    'large' : [ json.dumps({ 'ts' : 1792324800.0 + i, 'level' : ('info', 'warn', 'error')[i % 3], 'service' : 'api{}'.format(i % 10),
+                'msg' : 'GET /index.html {}'.format(i), 'http' : { 'status' : 200, 'bytes' : 612 + i, 'agent' : 'curl/7.68.0' },
+                'trace' : { 'id' : '{:032x}'.format(i), 'span' : '{:016x}'.format(i) }, 'tags' : [ 'web', 'prod', 'eu-west-1' ],
+                'host' : 'web{:02d}.example.com'.format(i % 10), 'pid' : 1234, 'thread' : 'worker-{}'.format(i % 8) }) for i in xrange(1000) ],
+    'invalid' : [ '{{"level":"info","service":"api","msg":"cut off {}'.format(i) for i in xrange(1000) ],
+    'plain' : [ 'Oct 18 12:00:00 api{}: request {} done'.format(i % 10, i) for i in xrange(1000) ],
+}
+
+class Naive:
+    def __init__(self, fmt):
+        self.fmt = fmt
+
+    def format(self, line):
+        try:
+            return self.fmt.format(**json.loads(line))
+        except (ValueError, KeyError):
+            return line
+
+def run(template, data, n):
+    fmt = template.format
+    start = time.time()
+    for i in xrange(n):
+        fmt(data[i % 1000])
+    return n / (time.time() - start)
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    print "decoder: " + json.__name__
+    print "{:>8} {:>8} {:<36} {:>12}".format("lines", "stage", "template", "lines/s")
+    for kind in ('small', 'large', 'invalid', 'plain'):
+        for fmt in ("{level} {service}: {msg}", "{level} {service} {http.status}: {msg}"):
+            if kind == 'small' and '.' in fmt:
+                continue
+            for name, template in (('compiled', JsonTemplate(fmt)), ('naive', Naive(fmt))):
+                if name == 'naive' and '.' in fmt:
+                    continue
+                print "{:>8} {:>8} {:<36} {:>12.0f}".format(kind, name, fmt, run(template, lines[kind], n))
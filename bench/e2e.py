@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""
+    End-to-end benchmark: starts irclogd as a subprocess, connects a fake irc
+    client which does the NICK/USER/JOIN/INVITE/input handshake, and then
+    blasts a udp port or a fifo with lines.
+
+    Every line carries the time it was sent, so the client can measure the
+    latency from the source to its socket. The result is printed as one JSON
+    object, with the sustained rate of lines received, latency percentiles,
+    and the cpu time and memory used by the server.
+
+    Run from the repository root:
+        python bench/e2e.py --input udp --lines 100000 --size 200 --channels 4
+        python bench/e2e.py --input fifo --rate 20000 --set queuepolicy=pause
+
+    Compare runs with e.g. jq, or by keeping the output of --json around.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def percentile(values, p):
+    if not values:
+        return None
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+class Server:
+    """
+        An irclogd subprocess, configured by a temporary config file.
+    """
+
+    def __init__(self, port, settings):
+        self.dir = tempfile.mkdtemp(prefix="irclogd-bench-")
+        self.config = os.path.join(self.dir, "irclogd.ini")
+        with open(self.config, 'w') as f:
+            f.write("[irclogd]\nport = {}\ndebug = false\n".format(port))
+            for key, value in settings:
+                f.write("{} = {}\n".format(key, value))
+
+        self.process = subprocess.Popen([ sys.executable, '-m', 'irclogd.irclogd', self.config ], cwd=root)
+        self.clock = os.sysconf('SC_CLK_TCK')
+
+    def cpu(self):
+        """
+            Returns the user and system cpu seconds used so far.
+        """
+        with open("/proc/{}/stat".format(self.process.pid)) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return float(int(fields[11]) + int(fields[12])) / self.clock
+
+    def memory(self):
+        """
+            Returns the current and peak resident set size in kB.
+        """
+        result = { }
+        with open("/proc/{}/status".format(self.process.pid)) as f:
+            for l in f:
+                if l.startswith("VmRSS:") or l.startswith("VmHWM:"):
+                    result[l[:5]] = int(l.split()[1])
+        return result.get("VmRSS"), result.get("VmHWM")
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        for name in os.listdir(self.dir):
+            os.unlink(os.path.join(self.dir, name))
+        os.rmdir(self.dir)
+
+class Client:
+    """
+        A minimal irc client, which records the latency of every PRIVMSG
+        carrying a timestamp.
+    """
+
+    def __init__(self, port, timeout = 10):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self.socket = socket.create_connection(('localhost', port))
+                break
+            except socket.error:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+        self.buf = ""
+        self.latencies = [ ]
+        self.bytes = 0
+        self.first = None
+        self.last = None
+
+    def send(self, line):
+        self.socket.sendall(line + "\r\n")
+
+    def lines(self):
+        data = self.socket.recv(1 << 16)
+        if not data:
+            raise Exception("Server closed the connection")
+        self.bytes += len(data)
+        lines = (self.buf + data).split("\r\n")
+        self.buf = lines.pop()
+        return lines
+
+    def waitFor(self, text, timeout = 10):
+        self.socket.settimeout(timeout)
+        while True:
+            for l in self.lines():
+                if text in l:
+                    return l
+
+    def receive(self, expected, idle):
+        """
+            Reads until expected lines arrived, or nothing arrived for idle
+            seconds.
+        """
+        self.socket.settimeout(idle)
+        latencies = self.latencies
+        while len(latencies) < expected:
+            try:
+                lines = self.lines()
+            except socket.timeout:
+                break
+            now = time.time()
+            for l in lines:
+                i = l.find(" PRIVMSG ")
+                if i < 0:
+                    continue
+                i = l.find(" :", i) + 2
+                try:
+                    sent = float(l[i:l.find(" ", i)])
+                except ValueError:
+                    continue
+                latencies.append(now - sent)
+                if self.first is None:
+                    self.first = now
+                self.last = now
+
+class Sender(threading.Thread):
+    """
+        Sends lines of the given size at the given rate (0 for as fast as
+        possible), perlines lines per udp datagram or fifo write.
+    """
+
+    def __init__(self, write, lines, size, rate, per):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.write = write
+        self.lines = lines
+        self.size = size
+        self.rate = rate
+        self.per = per
+        self.sent = 0
+        self.duration = None
+
+    def run(self):
+        padding = "x" * self.size
+        start = time.time()
+        while self.sent < self.lines:
+            n = min(self.per, self.lines - self.sent)
+            stamp = "{:.6f} ".format(time.time())
+            line = (stamp + padding)[:max(self.size, len(stamp))] + "\n"
+            self.write(line * n)
+            self.sent += n
+            if self.rate > 0:
+                ahead = float(self.sent) / self.rate - (time.time() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        self.duration = time.time() - start
+
+def udpWriter(port):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = ('127.0.0.1', port)
+    def write(data):
+        while True:
+            try:
+                s.sendto(data, address)
+                return
+            except socket.error as e:
+                if e.args[0] != errno.ENOBUFS:
+                    raise
+    return write
+
+def fifoWriter(path):
+    fd = os.open(path, os.O_WRONLY)
+    def write(data):
+        while data:
+            data = data[os.write(fd, data):]
+    return write
+
+def run(args):
+    server = Server(args.port, [ s.split('=', 1) for s in args.set ])
+    try:
+        client = Client(args.port)
+        client.send("NICK bench")
+        client.send("USER bench bench localhost :bench")
+        client.waitFor(" 004 ")
+
+        channels = [ "&bench{}".format(i) for i in xrange(args.channels) ]
+        for c in channels:
+            client.send("JOIN " + c)
+            client.send("INVITE source " + c)
+        client.waitFor(" 341 bench {} ".format(channels[-1]))
+
+        if args.input == 'udp':
+            client.send("PRIVMSG source :input udp {} {}".format(args.udpport, ' '.join(args.option)))
+            client.waitFor("Started listening")
+            write = udpWriter(args.udpport)
+        else:
+            fifo = os.path.join(server.dir, "fifo")
+            os.mkfifo(fifo)
+            client.send("PRIVMSG source :input fifo {} {}".format(fifo, ' '.join(args.option)))
+            client.waitFor("Reading from fifo")
+            write = fifoWriter(fifo)
+
+        cpu = server.cpu()
+        sender = Sender(write, args.lines, args.size, args.rate, args.per)
+        start = time.time()
+        sender.start()
+        client.receive(args.lines * args.channels, args.idle)
+        sender.join()
+        cpu = server.cpu() - cpu
+        rss, maxrss = server.memory()
+
+        latencies = sorted(client.latencies)
+        received = len(latencies)
+        elapsed = (client.last - start) if client.last is not None else None
+        return {
+            'time' : time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'params' : {
+                'input' : args.input,
+                'lines' : args.lines,
+                'size' : args.size,
+                'rate' : args.rate,
+                'per' : args.per,
+                'channels' : args.channels,
+                'options' : args.option,
+                'settings' : args.set,
+            },
+            'sent' : sender.sent,
+            'send_seconds' : sender.duration,
+            'received' : received,
+            'lost' : args.lines * args.channels - received,
+            'received_bytes' : client.bytes,
+            'seconds' : elapsed,
+            'lines_per_sec' : received / elapsed if elapsed else None,
+            'latency_p50' : percentile(latencies, 0.5),
+            'latency_p99' : percentile(latencies, 0.99),
+            'latency_max' : latencies[-1] if latencies else None,
+            'cpu_seconds' : cpu,
+            'cpu_percent' : 100 * cpu / elapsed if elapsed else None,
+            'rss_kb' : rss,
+            'max_rss_kb' : maxrss,
+        }
+    finally:
+        server.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end irclogd benchmark")
+    parser.add_argument('--input', choices=('udp', 'fifo'), default='udp')
+    parser.add_argument('--lines', type=int, default=100000, help="lines to send")
+    parser.add_argument('--size', type=int, default=100, help="bytes per line")
+    parser.add_argument('--rate', type=float, default=0, help="lines per second, 0 for unlimited")
+    parser.add_argument('--per', type=int, default=1, help="lines per datagram or fifo write")
+    parser.add_argument('--channels', type=int, default=1, help="channels the source is in")
+    parser.add_argument('--port', type=int, default=16700, help="irc port of the server")
+    parser.add_argument('--udpport', type=int, default=16701)
+    parser.add_argument('--option', action='append', default=[ ], help="input option, e.g. mode=batch")
+    parser.add_argument('--set', action='append', default=[ ], help="server setting, e.g. queuepolicy=pause")
+    parser.add_argument('--idle', type=float, default=2, help="seconds without data after which to stop")
+    parser.add_argument('--json', help="append the result to this file, one object per line")
+    args = parser.parse_args()
+
+    result = run(args)
+    print json.dumps(result, indent=2, sort_keys=True)
+    if args.json is not None:
+        with open(args.json, 'a') as f:
+            f.write(json.dumps(result, sort_keys=True) + "\n")
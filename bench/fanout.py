@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+    Micro-benchmark for the PseudoUser -> Channel fan-out path.
+
+    Compares the per-user send loop as it was before prefixes were cached
+    (copied below as generic: Channel.msg and sendMessage building the whole
+    line for every channel) with the cached prefix path of PseudoUser.msg,
+    for 1, 10 and 100 channels. Both end in the same sendLine and output
+    queue, so only the serialization differs. The cached path also keeps
+    the channel statistics, which the old loop did not. Nothing is written
+    to a socket, the transport discards all data.
+
+    Run from the repository root:
+        python bench/fanout.py [lines]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from twisted.words.protocols import irc
+from twisted.internet import protocol
+
+from irclogd.irclogd import IrclogdServer, Channel
+from irclogd.user import InputUser
+
+class NullTransport:
+    def write(self, data):
+        pass
+
+    def writeSequence(self, seq):
+        pass
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def loseConnection(self):
+        pass
+
+def makeServer():
+    factory = protocol.Factory()
+    factory.debug = False
+    factory.dropreport = 3600
+    server = IrclogdServer()
+    server.factory = factory
+    server.makeConnection(NullTransport())
+    server.nick = "bench"
+    return server
+
+def makeUser(server, channels):
+    user = InputUser(server, "bench")
+    server.pusers[user.name] = user
+    for i in xrange(channels):
+        c = Channel(server, "&bench{}".format(i))
+        server.channels[c.name] = c
+        user.invite(c)
+    return user
+
+def generic(user, line):
+    # PseudoUser.msg, Channel.msg and IrclogdServer.sendMessage before the
+    # prefix cache, without the debug output
+    for name in user.channels:
+        channel = user.channels[name]
+        server = channel.server
+        parameter_list = [ channel.name, irc.lowQuote(line) ]
+        parameter_list[-1] = ":" + parameter_list[-1]
+        data = ":%s %s" % (user.fullname(), ' '.join(['PRIVMSG'] + parameter_list))
+        server.sendLine(data, parameter_list[0])
+
+def cached(user, line):
+    user.msg(line)
+
+def run(path, user, lines):
+    line = "x" * 100
+    start = time.time()
+    for i in xrange(lines):
+        path(user, line)
+    return lines / (time.time() - start)
+
+if __name__ == "__main__":
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    print "{:>8} {:>14} {:>14} {:>8}".format("channels", "generic/s", "cached/s", "speedup")
+    for channels in (1, 10, 100):
+        server = makeServer()
+        user = makeUser(server, channels)
+        n = max(lines / channels, 100)
+        before = run(generic, user, n)
+        after = run(cached, user, n)
+        print "{:>8} {:>14.0f} {:>14.0f} {:>7.1f}x".format(channels, before, after, after / before)
+        server.connectionLost(None)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+    Control path benchmark: how long does irclogd take to answer a PING
+    while a fifo input is saturated? A yes process writes lines into the
+    fifo as fast as it can, and a drop rule discards them after framing, so
+    the client only has to read the PONGs and what it measures is the time
+    the server takes to get to its socket.
+
+    Every budget given is one run with that readbudget setting, the result is
+    one line per run with the PING round trip percentiles and the rate of
+    lines read from the fifo meanwhile.
+
+    Run from the repository root:
+        python bench/ping.py --budget 65536 --budget 1048576
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import subprocess
+
+from e2e import Server, Client, percentile
+
+def run(args, budget):
+    settings = [ ('readbudget', budget) ] if budget is not None else [ ]
+    server = Server(args.port, settings)
+    writer = None
+    try:
+        client = Client(args.port)
+        client.send("NICK bench")
+        client.send("USER bench bench localhost :bench")
+        client.waitFor(" 004 ")
+        client.send("JOIN &bench")
+        client.send("INVITE source &bench")
+        client.waitFor(" 341 bench &bench ")
+
+        fifo = os.path.join(server.dir, "fifo")
+        os.mkfifo(fifo)
+        client.send("PRIVMSG source :drop /./")
+        client.send("PRIVMSG source :input fifo " + fifo)
+        client.waitFor("Reading from fifo")
+        writer = subprocess.Popen([ 'yes', 'x' * args.size ], stdout=open(fifo, 'w'))
+        time.sleep(args.warmup)
+
+        rtts = [ ]
+        for i in xrange(args.pings):
+            sent = time.time()
+            client.send("PING :{}".format(i))
+            try:
+                client.waitFor("PONG", args.timeout)
+            except socket.timeout:
+                # the server doesn't get to its socket at all
+                return budget, None, None, None, None
+            rtts.append(time.time() - sent)
+            time.sleep(args.interval)
+
+        client.send("PRIVMSG source :stats")
+        stats = client.waitFor(" lines received")
+        received = int(stats.split(": ")[-1].split()[0])
+        elapsed = args.warmup + sum(rtts) + args.pings * args.interval
+
+        rtts.sort()
+        return budget, percentile(rtts, 0.5), percentile(rtts, 0.99), rtts[-1], received / elapsed
+    finally:
+        if writer is not None:
+            writer.kill()
+            writer.wait()
+        server.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PING latency under a saturated fifo")
+    parser.add_argument('--budget', action='append', default=[ ], help="readbudget setting in bytes, one run each")
+    parser.add_argument('--pings', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=0.02, help="seconds between pings")
+    parser.add_argument('--warmup', type=float, default=1, help="seconds of writing before the first ping")
+    parser.add_argument('--size', type=int, default=100, help="bytes per line")
+    parser.add_argument('--timeout', type=float, default=10, help="seconds to wait for a PONG")
+    parser.add_argument('--port', type=int, default=16700, help="irc port of the server")
+    args = parser.parse_args()
+
+    print "{:>10} {:>10} {:>10} {:>10} {:>12}".format("budget", "p50 ms", "p99 ms", "max ms", "fifo lines/s")
+    for budget in args.budget or [ None ]:
+        budget, p50, p99, worst, rate = run(args, budget)
+        if p50 is None:
+            print "{:>10} no PONG within {}s".format(budget or "default", args.timeout)
+            continue
+        print "{:>10} {:>10.2f} {:>10.2f} {:>10.2f} {:>12.0f}".format(budget or "default", p50 * 1000, p99 * 1000, worst * 1000, rate)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+    Micro-benchmark for the syslog input: parsing, severity filtering and
+    formatting of RFC 3164 and RFC 5424 messages, as done for every
+    datagram. Nothing is received from or written to a socket, the virtual
+    user only counts the lines it gets.
+
+    Run from the repository root:
+        python bench/syslog.py [messages]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from irclogd.input.syslog import SyslogSource, SyslogInput
+
+messages = {
+    'rfc5424' : [ '<{}>1 2026-10-18T12:00:{:02d}.123Z web{:02d} nginx 1234 ID47 [meta seq="{}"] GET /index.html 200 612 "curl/7.68.0"'.format(8 + i % 8, i % 60, i % 10, i) for i in xrange(1000) ],
+    'rfc3164' : [ '<{}>Oct 18 12:00:{:02d} web{:02d} sshd[{}]: Accepted publickey for deploy from 10.0.0.{} port 52311 ssh2'.format(32 + i % 8, i % 60, i % 10, 800 + i, i % 250) for i in xrange(1000) ],
+}
+
+class CountingUser:
+    def __init__(self):
+        self.lines = 0
+
+    def msg(self, line):
+        self.lines += 1
+
+    def notice(self, msg):
+        pass
+
+def run(kind, severity, fmt, n):
+    source = SyslogSource(5514, { })
+    user = CountingUser()
+    source.subscribe(SyslogInput(source, user, [ ], severity, fmt))
+
+    data = messages[kind]
+    receive = source.datagramReceived
+    addr = ('10.0.0.1', 514)
+    start = time.time()
+    for i in xrange(n):
+        receive(data[i % 1000], addr)
+    elapsed = time.time() - start
+    return n / elapsed, user.lines
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+    print "{:>8} {:>9} {:<32} {:>12} {:>8}".format("format", "severity", "template", "messages/s", "shown")
+    for kind in ('rfc5424', 'rfc3164'):
+        for severity, fmt in (('debug', None), ('debug', "{msg}"), ('debug', "{raw}"), ('warning', None), ('err', None)):
+            rate, shown = run(kind, severity, fmt, n)
+            print "{:>8} {:>9} {:<32} {:>12.0f} {:>7.0f}%".format(kind, severity, fmt or SyslogInput.defaultFormat, rate, 100.0 * shown / n)
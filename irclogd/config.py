@@ -0,0 +1,112 @@
+import ConfigParser
+
+class Config:
+    """
+        A declarative startup configuration, read from an ini style file:
+
+            [irclogd]
+            port = 6700
+            scrollbacklines = 1000
+
+            [channel &alerts]
+            topic = Things that are on fire
+            dedup = 10s
+
+            [user udp1]
+            channels = &alerts, &firehose
+            input = udp 12345
+            format = json {level} {service}: {msg}
+            ratelimit = 50/s burst 200
+            routes = /ERROR|CRIT/ &alerts
+                     drop /healthcheck/
+                     * &firehose
+
+        The irclogd section overrides the module level settings. Channels and
+        users are created for every client once it registered. Channels
+        referenced by users don't need a section of their own.
+    """
+
+    channeloptions = ('topic', 'dedup')
+    useroptions = ('channels', 'input', 'format', 'ratelimit', 'routes')
+
+    def __init__(self, path):
+        parser = ConfigParser.RawConfigParser()
+        try:
+            if not parser.read(path):
+                raise Exception("Could not read config file: " + path)
+        except ConfigParser.Error as e:
+            raise Exception("Invalid config file: " + str(e))
+
+        self.settings = { }
+        # lists of (name, options), in order of appearance
+        self.channels = [ ]
+        self.users = [ ]
+
+        for section in parser.sections():
+            options = dict(parser.items(section))
+            if section == "irclogd":
+                self.settings = options
+            elif section.startswith("channel "):
+                self.channels.append((section[8:].strip(), options))
+            elif section.startswith("user "):
+                self.users.append((section[5:].strip(), options))
+            else:
+                raise Exception("Unknown config section: " + section)
+
+        names = [ name for name, options in self.channels ]
+        for name, options in self.channels:
+            if name[0] not in [ '#', '&' ]:
+                raise Exception("Invalid channel name: " + name)
+            check(options, Config.channeloptions, "channel " + name)
+
+        for name, options in self.users:
+            check(options, Config.useroptions, "user " + name)
+            channels = [ c.strip() for c in options.get('channels', '').split(',') if c.strip() ]
+            if len(channels) == 0:
+                raise Exception("User {} is not in any channel".format(name))
+            options['channels'] = channels
+            for c in channels:
+                if c not in names:
+                    if c[0] not in [ '#', '&' ]:
+                        raise Exception("Invalid channel name: " + c)
+                    self.channels.append((c, { }))
+                    names.append(c)
+
+    def apply(self, factory, defaults):
+        """
+            Sets the settings of the irclogd section on the factory. Values
+            are converted to the type of the according module level default
+            in defaults.
+        """
+        for key, value in self.settings.iteritems():
+            if key.startswith('_') or not hasattr(defaults, key) \
+                    or not isinstance(getattr(defaults, key), (bool, int, long, float, str, type(None))):
+                raise Exception("Unknown setting: " + key)
+            setattr(factory, key, convert(value, getattr(defaults, key)))
+
+    def get(self, key, default):
+        return convert(self.settings[key], default) if key in self.settings else default
+
+def check(options, known, section):
+    for key in options:
+        if key not in known:
+            raise Exception("Unknown option {} in section {}".format(key, section))
+
+def convert(value, default):
+    """
+        Converts a string value to the type of default.
+    """
+    try:
+        if isinstance(default, bool):
+            if value.lower() not in ConfigParser.RawConfigParser._boolean_states:
+                raise ValueError()
+            return ConfigParser.RawConfigParser._boolean_states[value.lower()]
+        if isinstance(default, (int, long)):
+            return float(value) if '.' in value else int(value)
+        if isinstance(default, float):
+            return float(value)
+    except ValueError:
+        raise Exception("Invalid value: " + value)
+    if value.lower() == 'none':
+        return None
+    return value
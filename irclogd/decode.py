@@ -0,0 +1,166 @@
+import string
+import operator
+
+# the fastest decoder around, all of them raise a ValueError on invalid input
+try:
+    import ujson as json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        import json
+
+if json.__name__ == 'json':
+    def decode(line, scan = json.JSONDecoder().scan_once):
+        """
+            json.loads without its regex matching for leading and trailing
+            whitespace, a line is a single object starting right away.
+        """
+        try:
+            obj, end = scan(line, 0)
+        except StopIteration:
+            raise ValueError("No JSON object")
+        if end != len(line) and line[end:].strip():
+            raise ValueError("Extra data")
+        return obj
+else:
+    decode = json.loads
+
+def utf8(s):
+    return s.encode('utf-8') if isinstance(s, unicode) else s
+
+# values which can't be formatted as they are
+special = frozenset((type(None), dict, list))
+
+class JsonTemplate:
+    """
+        Shows JSON lines as a display format like "{level} {service}: {msg}".
+
+        The format is compiled once into a positional format string and the
+        list of fields it references, so for every line only these fields
+        are looked up, and nothing else of the decoded object is touched.
+        Fields of nested objects are referenced with dots, like
+        {http.status}. Fields missing from a line, or null, are shown as -,
+        nested objects and arrays as JSON.
+
+        Lines which are not JSON objects, which fail to decode, which have
+        none of the fields or whose fields don't fit the format are shown as
+        they are.
+    """
+
+    missing = '-'
+
+    def __init__(self, fmt):
+        self.fmt = fmt
+
+        parts = [ ]
+        paths = [ ]
+        try:
+            for literal, field, spec, conv in string.Formatter().parse(fmt):
+                # parameters are unicode, the parts are joined as utf-8 bytes
+                literal, spec = utf8(literal), utf8(spec)
+                parts.append(literal.replace('{', '{{').replace('}', '}}'))
+                if field is None:
+                    continue
+                if not field or '[' in field:
+                    raise ValueError("fields must be names, like {msg} or {http.status}")
+                parts.append("{{{}{}{}}}".format(len(paths), '!' + conv if conv else '', ':' + spec if spec else ''))
+                paths.append(tuple(field.split('.')))
+            # decoded strings are unicode, the line is encoded once formatted
+            compiled = ''.join(parts).decode('utf-8')
+        except ValueError as e:
+            raise Exception("Invalid format: " + str(e))
+        if not paths:
+            raise Exception("Invalid format: no fields in " + fmt)
+
+        self.compiled = compiled
+        self.paths = paths
+
+        # without nested fields, all values are fetched in one call
+        self.getter = None
+        if all(len(p) == 1 for p in paths):
+            if len(paths) == 1:
+                key = paths[0][0]
+                self.getter = lambda obj: (obj[key], )
+            else:
+                self.getter = operator.itemgetter(*[ p[0] for p in paths ])
+
+        # statistics
+        self.decoded = 0
+        self.raw = 0
+        self.errors = 0
+
+    def __str__(self):
+        return "json " + self.fmt
+
+    def format(self, line):
+        if line[:1] != '{':
+            self.raw += 1
+            return line
+
+        try:
+            obj = decode(line)
+            if type(obj) is not dict:
+                raise ValueError("Not an object")
+            values = self.values(obj)
+            if values is None:
+                raise ValueError("None of the fields")
+            line = self.compiled.format(*values).encode('utf-8')
+        except (ValueError, TypeError):
+            self.errors += 1
+            return line
+
+        self.decoded += 1
+        return line
+
+    def values(self, obj):
+        """
+            Returns the values of the fields in obj, ready to be formatted,
+            or None if obj has none of them.
+        """
+        if self.getter is not None:
+            try:
+                values = self.getter(obj)
+                for v in values:
+                    if type(v) in special:
+                        break
+                else:
+                    return values
+            except KeyError:
+                pass
+
+        values = [ lookup(obj, p) for p in self.paths ]
+        found = False
+        for i, v in enumerate(values):
+            if v is None:
+                values[i] = JsonTemplate.missing
+            else:
+                found = True
+                if type(v) in special:
+                    values[i] = json.dumps(v)
+        return values if found else None
+
+    def stats(self):
+        return "format {}: {} lines decoded, {} not json, {} shown raw after errors".format(
+                self, self.decoded, self.raw, self.errors)
+
+def lookup(obj, path):
+    for key in path:
+        if type(obj) is not dict:
+            return None
+        obj = obj.get(key)
+    return obj
+
+def TemplateFromParams(params):
+    """
+        Creates a template from format command parameters:
+            json "{field} {other.field}.."
+        The quotes are optional.
+    """
+    if len(params) < 2 or params[0] != 'json':
+        raise Exception('Usage: format json "{field} {other.field}.."')
+
+    fmt = ' '.join(params[1:])
+    if len(fmt) > 1 and fmt[0] == fmt[-1] and fmt[0] in '"\'':
+        fmt = fmt[1:-1]
+    return JsonTemplate(fmt)
@@ -0,0 +1,94 @@
+import time
+import struct
+import hashlib
+import collections
+
+from logstore import parseDuration
+
+# the first 64 bits of the md5 of a line stand in for it
+digest = struct.Struct("<q")
+
+class DedupWindow:
+    """
+        Remembers the lines of the last window seconds, at most maxentries of
+        them, and tells which lines are repeats of one of those.
+
+        Lines are kept as 64 bit hashes, in a dict from hash to expiry time,
+        and in the order they were first seen, in which they also expire.
+        Once maxentries is reached, the oldest entries are evicted. A repeat
+        doesn't extend the window, so a line sent over and over again still
+        shows up once per window.
+    """
+
+    def __init__(self, window, maxentries):
+        self.window = window
+        self.maxentries = maxentries
+
+        self.expiries = { }
+        # hashes and their expiry times, oldest first
+        self.order = collections.deque()
+        self.times = collections.deque()
+
+        # statistics
+        self.suppressed = 0
+        self.evicted = 0
+
+    def seen(self, line):
+        """
+            Returns True if the line was seen within the window, otherwise
+            remembers it and returns False.
+        """
+        now = time.time()
+        expiries = self.expiries
+        order = self.order
+        times = self.times
+
+        # forget what expired, a hash seen again since has a later expiry
+        while times and times[0] <= now:
+            h = order.popleft()
+            expiry = times.popleft()
+            if expiries.get(h) == expiry:
+                del expiries[h]
+
+        h = digest.unpack_from(hashlib.md5(line).digest())[0]
+        if h in expiries:
+            self.suppressed += 1
+            return True
+
+        expiry = now + self.window
+        expiries[h] = expiry
+        order.append(h)
+        times.append(expiry)
+        if len(order) > self.maxentries:
+            h = order.popleft()
+            expiry = times.popleft()
+            if expiries.get(h) == expiry:
+                del expiries[h]
+                self.evicted += 1
+        return False
+
+    def __str__(self):
+        return "{:g}s entries {}".format(self.window, self.maxentries)
+
+    def stats(self):
+        return "dedup {}: {} lines remembered, {} duplicates suppressed, {} evicted early".format(
+                self, len(self.expiries), self.suppressed, self.evicted)
+
+def DedupWindowFromParams(params):
+    """
+        Creates a DedupWindow from dedup command parameters:
+            duration [entries n]
+    """
+    try:
+        window = parseDuration(params[0])
+        opts = dict(zip(params[1::2], params[2::2]))
+        maxentries = int(opts.pop('entries', 10000))
+    except Exception:
+        raise Exception("Usage: dedup duration [entries n]")
+    if opts or len(params) % 2 == 0:
+        raise Exception("Usage: dedup duration [entries n]")
+
+    if window <= 0 or maxentries < 1:
+        raise Exception("Duration and entries must be positive!")
+
+    return DedupWindow(window, maxentries)
@@ -0,0 +1,137 @@
+import time
+
+from twisted.internet import reactor
+
+class TokenBucket:
+    """
+        A token bucket, refilled with rate tokens per second and holding at
+        most burst tokens.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = time.time()
+
+    def take(self):
+        """
+            Takes a token from the bucket, if there is one.
+        """
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def spend(self, n):
+        """
+            Takes n tokens, going into debt if there are not enough. Returns
+            the seconds until the debt is paid off.
+        """
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate) - n
+        self.last = now
+        return max(0.0, -self.tokens / self.rate)
+
+class FloodGate:
+    """
+        Sits between an input and the output of a virtual user, protecting
+        the connection from floods.
+
+        Consecutive identical lines are collapsed into a single "last message
+        repeated N times" line, and lines exceeding the rate limit are dropped
+        and summarized in a "N lines suppressed" line. Both summaries are
+        reported in order with the other lines, at the latest after window
+        seconds.
+    """
+
+    def __init__(self, output, rate, burst, window = 10):
+        self.output = output
+        self.bucket = TokenBucket(rate, burst)
+        self.window = window
+
+        # last line and how many times it was repeated since
+        self.last = None
+        self.repeats = 0
+        self.repeatcall = None
+
+        # lines suppressed in the current window
+        self.suppressed = 0
+        self.suppressstart = None
+        self.suppresscall = None
+
+    def msg(self, msg):
+        if msg == self.last:
+            self.repeats += 1
+            if self.repeatcall is None:
+                self.repeatcall = reactor.callLater(self.window, self.flushRepeats)
+            return
+
+        self.flushRepeats()
+
+        if self.bucket.take():
+            self.last = msg
+            self.output(msg)
+            return
+
+        # repeats of a suppressed line are suppressed as well
+        self.last = None
+        self.suppressed += 1
+        if self.suppresscall is None:
+            self.suppressstart = time.time()
+            self.suppresscall = reactor.callLater(self.window, self.flushSuppressed)
+
+    def flushRepeats(self):
+        if self.repeatcall is not None:
+            if self.repeatcall.active():
+                self.repeatcall.cancel()
+            self.repeatcall = None
+
+        if self.repeats > 0:
+            self.output("last message repeated {} times".format(self.repeats))
+            self.repeats = 0
+            # a repeat after the summary is a new line again
+            self.last = None
+
+    def flushSuppressed(self):
+        self.suppresscall = None
+        if self.suppressed > 0:
+            self.output("{} lines suppressed in the last {:.0f}s".format(self.suppressed, time.time() - self.suppressstart))
+            self.suppressed = 0
+
+    def stop(self):
+        """
+            Reports what is pending and cancels all timers.
+        """
+        self.flushRepeats()
+        if self.suppresscall is not None:
+            self.suppresscall.cancel()
+            self.flushSuppressed()
+
+def FloodGateFromParams(output, params):
+    """
+        Creates a FloodGate from ratelimit command parameters:
+            rate[/s|/m] [burst n] [window seconds]
+    """
+    try:
+        rate = params[0]
+        per = 1
+        if '/' in rate:
+            rate, unit = rate.split('/', 1)
+            per = { 's' : 1, 'm' : 60, 'h' : 3600 }[unit]
+        rate = float(rate) / per
+
+        opts = dict(zip(params[1::2], params[2::2]))
+        burst = int(opts.get('burst', max(rate, 1)))
+        window = float(opts.get('window', 10))
+    except (IndexError, KeyError, ValueError):
+        raise Exception("Usage: ratelimit rate[/s|/m|/h] [burst n] [window seconds]")
+
+    if rate <= 0 or burst < 1:
+        raise Exception("Rate and burst must be positive!")
+
+    return FloodGate(output, rate, burst, window)
@@ -0,0 +1,26 @@
+def splitParams(params):
+    """
+        Splits input parameters into positional arguments and key=value
+        options, which may be given in any order.
+    """
+    args = [ ]
+    opts = { }
+    for p in params:
+        if '=' in p:
+            key, value = p.split('=', 1)
+            opts[key] = value
+        else:
+            args.append(p)
+    return args, opts
+
+def parseSize(s):
+    """
+        Parses sizes like 512, 64k or 8M into bytes.
+    """
+    units = { 'k' : 1024, 'm' : 1024*1024, 'g' : 1024*1024*1024 }
+    try:
+        if s[-1].lower() in units:
+            return int(s[:-1]) * units[s[-1].lower()]
+        return int(s)
+    except (IndexError, ValueError):
+        raise Exception("Invalid size: " + s)
@@ -0,0 +1,187 @@
+import socket
+import binascii
+
+from twisted.internet import task, threads
+
+from irclogd.input import hub
+
+def parseAddress(host):
+    """
+        Returns (family, integer value) of an ip address, or None if host is
+        no ip address. IPv4-mapped IPv6 addresses are returned as the IPv4
+        address, so every address has exactly one parsed form.
+    """
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            value = int(binascii.hexlify(socket.inet_pton(family, host)), 16)
+        except (socket.error, ValueError):
+            continue
+        if family == socket.AF_INET6 and value >> 32 == 0xffff:
+            return socket.AF_INET, value & 0xffffffff
+        return family, value
+    return None
+
+class HostFilter:
+    """
+        An allowlist of sending hosts. Entries may be ip addresses, CIDR
+        ranges (10.0.0.0/24, fe80::/10) or hostnames.
+
+        Literal addresses and resolved hostnames are kept in a set, parsed,
+        so different spellings of the same address match. Ranges are
+        kept in one set of network numbers per prefix length, so a lookup
+        costs one set lookup per distinct prefix length, however many ranges
+        there are. Decisions are cached per host on top of that.
+
+        Hostnames are resolved in a thread and re-resolved every ttl seconds.
+        Until a hostname is resolved, nothing from it is accepted.
+
+        Accepted and rejected datagrams are counted per sending host, for at
+        most maxsources hosts. Everything beyond that is counted as others.
+    """
+
+    bits = { socket.AF_INET : 32, socket.AF_INET6 : 128 }
+    maxsources = 1024
+    maxcache = 4096
+
+    def __init__(self, entries, notice, ttl = 300):
+        self.entries = entries
+        self.notice = notice
+
+        self.exact = set()
+        # (family, prefix length) -> set of network numbers
+        self.networks = { }
+        # hostname -> set of addresses
+        self.hostnames = { }
+        self.resolved = set()
+
+        for e in entries:
+            if '/' in e:
+                addr, length = e.split('/', 1)
+                parsed = parseAddress(addr)
+                try:
+                    length = int(length)
+                except ValueError:
+                    parsed = None
+                if parsed is not None and parsed[0] == socket.AF_INET and ':' in addr:
+                    # an ipv4-mapped range, like ::ffff:10.0.0.0/104
+                    length -= 96
+                if parsed is None or not 0 <= length <= HostFilter.bits[parsed[0]]:
+                    raise Exception("Invalid address range: " + e)
+                family, value = parsed
+                shift = HostFilter.bits[family] - length
+                self.networks.setdefault((family, length), set()).add(value >> shift)
+            elif parseAddress(e) is not None:
+                self.exact.add(parseAddress(e))
+            else:
+                self.hostnames[e] = set()
+
+        self.cache = { }
+
+        # host -> [accepted, rejected]
+        self.sources = { }
+        self.others = [ 0, 0 ]
+
+        self.resolvecall = None
+        if self.hostnames:
+            self.resolvecall = task.LoopingCall(self.resolve)
+            self.resolvecall.start(ttl)
+
+    def accepts(self, host, n = 1):
+        """
+            Checks whether n datagrams from host are accepted, and counts
+            them.
+        """
+        ok = self.cache.get(host)
+        if ok is None:
+            ok = self.lookup(host)
+            if len(self.cache) >= HostFilter.maxcache:
+                self.cache.clear()
+            self.cache[host] = ok
+
+        counts = self.sources.get(host)
+        if counts is None:
+            if len(self.sources) < HostFilter.maxsources:
+                counts = self.sources[host] = [ 0, 0 ]
+            else:
+                counts = self.others
+        counts[0 if ok else 1] += n
+        return ok
+
+    def lookup(self, host):
+        parsed = parseAddress(host)
+        if parsed is None:
+            return False
+        if parsed in self.exact or parsed in self.resolved:
+            return True
+        family, value = parsed
+        bits = HostFilter.bits[family]
+        for (f, length), networks in self.networks.iteritems():
+            if f == family and value >> (bits - length) in networks:
+                return True
+        return False
+
+    def resolve(self):
+        for name in self.hostnames:
+            d = threads.deferToThread(socket.getaddrinfo, name, None, 0, socket.SOCK_DGRAM)
+            d.addCallbacks(self.update, self.failed, callbackArgs=(name,), errbackArgs=(name,))
+
+    def update(self, infos, name):
+        self.hostnames[name] = set(parseAddress(info[4][0].split('%', 1)[0]) for info in infos)
+        self.resolved = set()
+        for addrs in self.hostnames.itervalues():
+            self.resolved |= addrs
+        self.cache.clear()
+
+    def failed(self, failure, name):
+        self.notice("Could not resolve {}: {}".format(name, failure.getErrorMessage()))
+
+    def stop(self):
+        if self.resolvecall is not None and self.resolvecall.running:
+            self.resolvecall.stop()
+
+    def stats(self, top = 5):
+        """
+            Returns a list of human readable statistic lines, showing the top
+            senders.
+        """
+        result = [ ]
+        ranked = sorted(self.sources.iteritems(), key=lambda i: -sum(i[1]))
+        for host, (accepted, rejected) in ranked[:top]:
+            result.append("{}: {} accepted, {} rejected".format(host, accepted, rejected))
+        rest = [ counts for host, counts in ranked[top:] ] + [ self.others ]
+        if sum(sum(c) for c in rest) > 0:
+            result.append("other hosts: {} accepted, {} rejected".format(sum(c[0] for c in rest), sum(c[1] for c in rest)))
+        return result
+
+class HostSubscription(hub.Subscription):
+    """
+        A subscription to an input with sending hosts.
+
+        If a list of hosts is given as optional parameter, all messages from
+        hosts not on this list will be ignored. The list may contain
+        addresses, CIDR ranges and hostnames, separated by spaces or commas.
+    """
+
+    def __init__(self, source, user, params):
+        hub.Subscription.__init__(self, source, user)
+        self.acceptedHosts = None
+        self.filter = None
+
+        hosts = [ h for p in params for h in p.split(',') if h ]
+        if len(hosts) > 0:
+            self.acceptedHosts = hosts
+            self.filter = HostFilter(hosts, user.notice)
+
+    def accepts(self, host, n = 1):
+        return self.filter is None or self.filter.accepts(host, n)
+
+    def stats(self):
+        result = hub.Subscription.stats(self)
+        if self.filter is not None:
+            result.extend(self.filter.stats())
+        return result
+
+    def destroy(self):
+        if self.filter is not None:
+            self.filter.stop()
+        hub.Subscription.destroy(self)
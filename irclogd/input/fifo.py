@@ -1,30 +1,117 @@
 import stat
 import os
+import time
 
-from twisted.internet import reactor, protocol
+from twisted.internet import reactor, protocol, error
 
 import lib.fifo
 
-class FifoInput(protocol.Protocol):
+from irclogd import metrics
+from irclogd.input import splitParams, hub
+from irclogd.input.framer import FramerFromOptions
+from irclogd.input.plugins import Schema
+from irclogd.input.worker import WorkerSource, parseWorkers
+
+class FifoSource(hub.Source, protocol.Protocol):
+    """
+        This source reads a fifo until its last writer closes it, unless it
+        is persistent:
+
+        With persist=hold, the source holds a write descriptor of its own,
+        so the fifo never ends, and writers can come and go without anything
+        being opened again. A last line without a newline waits for the
+        next writer, though.
+
+        With persist=reopen, the fifo is opened again right away once the
+        last writer closed it, after reporting what is left of its last
+        line. These open/close cycles are counted.
+    """
     name = "fifo"
 
-    def __init__(self, user, path, params):
-        self.user = user
+    def __init__(self, path, opts):
+        hub.Source.__init__(self, ('fifo', path), FramerFromOptions(self.deliver, opts), opts)
         self.path = path
+        self.persist = opts.get('persist')
+        self.writefd = None
+        self.closing = False
+
+        # statistics
+        self.reopens = 0
+
+    def open(self):
+        lib.fifo.readFromFIFO(reactor, self.path, self)
+        if self.persist == 'hold' and self.writefd is None:
+            self.writefd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+        if self.pauses > 0:
+            self.transport.stopReading()
 
     def connectionMade(self):
-        self.user.notice("Reading from fifo: " + self.path)
+        self.transport.budget = self.budget
+        if self.reopens == 0:
+            self.notice("Reading from fifo: " + self.path)
 
     def dataReceived(self, data):
-        lines = data.split("\n")
-        for l in lines:
-            if len(l) > 0:
-                self.user.msg(l)
+        self.bytes += len(data)
+        metrics.received = time.time()
+        self.framer.feed(data)
+        metrics.received = None
+
+    def connectionLost(self, reason):
+        # the writer is gone, report what is left of the last line
+        self.framer.flush()
+        if self.persist == 'reopen' and not self.closing and reason.check(error.ConnectionDone):
+            self.reopens += 1
+            self.open()
+            return
+        # whoever asks for this fifo next gets a fresh reader
+        self.unregister()
+
+    def stats(self):
+        result = hub.Source.stats(self)
+        if self.persist == 'hold':
+            result.append("fifo {}: persistent, holding a write descriptor".format(self.path))
+        elif self.persist == 'reopen':
+            result.append("fifo {}: persistent, reopened {} times".format(self.path, self.reopens))
+        return result
+
+    def metrics(self):
+        for m in hub.Source.metrics(self):
+            yield m
+        yield "fifo_reopens_total", "counter", { 'input' : 'fifo:' + self.path }, self.reopens
+
+    def pauseReading(self):
+        self.transport.stopReading()
+
+    def resumeReading(self):
+        self.transport.startReading()
 
-    def destroy(self):
+    def close(self):
+        self.closing = True
         self.transport.loseConnection()
+        if self.writefd is not None:
+            os.close(self.writefd)
+            self.writefd = None
+
+class FifoWorkerSource(WorkerSource):
+    """
+        A fifo read by a worker process. There is only ever one, since
+        several readers would tear lines apart.
+    """
+    name = "fifo"
+    endsOnExit = True
+
+    def __init__(self, path, opts):
+        framer = FramerFromOptions(None, opts)
+        WorkerSource.__init__(self, ('fifo', path), framer,
+                [ 'fifo', path, str(framer.maxlen), framer.overflow, opts.get('persist', 'none') ], 1, opts)
+        self.path = path
+
+    def start(self):
+        WorkerSource.start(self)
+        self.notice("Reading from fifo in a worker: " + self.path)
 
 def FifoInputFactory(user, params):
+    params, opts = splitParams(params)
 
     # need exactly one argument
     if len(params) != 1:
@@ -38,7 +125,34 @@ def FifoInputFactory(user, params):
     if not stat.S_ISFIFO(os.stat(path).st_mode):
         raise Exception("Path argument is not a valid fifo!")
 
+    # the same fifo may be given by different paths
+    path = os.path.realpath(path)
+
+    source = hub.getSource(('fifo', path))
+    if source is not None:
+        hub.checkOptions(source, opts)
+        user.notice("Sharing fifo {} with {} other readers".format(path, len(source.subscriptions)))
+        proto = hub.Subscription(source, user)
+        source.subscribe(proto)
+        return proto
+
+    if parseWorkers(opts) is not None:
+        if parseWorkers(opts) != 1:
+            raise Exception("A fifo can only be read by one worker")
+        source = FifoWorkerSource(path, opts)
+        proto = hub.Subscription(source, user)
+        source.subscribe(proto)
+        source.start()
+        source.register()
+        return proto
+
     # ok then, set everything up to read from it
-    proto = FifoInput(user, path, params[1:])
-    lib.fifo.readFromFIFO(reactor, path, proto)
+    source = FifoSource(path, opts)
+    proto = hub.Subscription(source, user)
+    source.subscribe(proto)
+    source.open()
+    source.register()
     return proto
+
+schema = Schema([ ('path', str) ], options = { 'workers' : int, 'persist' : ('hold', 'reopen') })
+factory = FifoInputFactory
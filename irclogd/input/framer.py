@@ -0,0 +1,127 @@
+class LineFramer:
+    """
+        Incremental line framer, shared by all stream based inputs.
+
+        Data is fed in arbitrarily sized chunks, and every complete line is
+        handed to the callback. A partial line at the end of a chunk is kept
+        and completed by the following chunks.
+
+        Lines longer than maxlen are handled according to the overflow
+        policy:
+            truncate: the first maxlen bytes are reported, the rest of the
+                      line is discarded
+            drop:     the whole line is discarded
+            split:    the line is reported in pieces of maxlen bytes
+    """
+
+    policies = ('truncate', 'drop', 'split')
+
+    def __init__(self, callback, maxlen = 4096, overflow = 'split'):
+        if overflow not in LineFramer.policies:
+            raise Exception("Unknown overflow policy: " + str(overflow))
+        if maxlen < 1:
+            raise Exception("Maximum line length must be positive!")
+
+        self.callback = callback
+        self.maxlen = maxlen
+        self.overflow = overflow
+
+        # partial line carried over from the previous chunk
+        self.buf = ''
+        # true while the rest of an overlong line is skipped
+        self.discarding = False
+
+        # number of lines which hit the length limit
+        self.overflows = 0
+
+    def feed(self, data):
+        """
+            Feeds a chunk of data, reporting all lines completed by it.
+        """
+        if self.buf:
+            data = self.buf + data
+            self.buf = ''
+
+        find = data.find
+        callback = self.callback
+        maxlen = self.maxlen
+
+        start = 0
+        end = find("\n")
+        while end >= 0:
+            if self.discarding:
+                # this newline terminates a line we already dealt with
+                self.discarding = False
+            elif end - start > maxlen:
+                self.overlong(data, start, end)
+            elif end > start:
+                callback(data[start:end])
+            start = end + 1
+            end = find("\n", start)
+
+        # whatever is left is an incomplete line
+        if start < len(data) and not self.discarding:
+            if len(data) - start > maxlen:
+                self.partial(data, start)
+            else:
+                self.buf = data[start:]
+
+    def flush(self):
+        """
+            Reports the pending partial line, if there is one. Used for inputs
+            where the end of a chunk also terminates the line, or when the
+            input is closed.
+        """
+        if self.buf:
+            self.callback(self.buf)
+            self.buf = ''
+        self.discarding = False
+
+    def reset(self):
+        """
+            Discards any pending partial line.
+        """
+        self.buf = ''
+        self.discarding = False
+
+    def overlong(self, data, start, end):
+        """
+            Handles a complete line which exceeds maxlen.
+        """
+        self.overflows += 1
+        if self.overflow == 'truncate':
+            self.callback(data[start:start+self.maxlen])
+        elif self.overflow == 'split':
+            for i in xrange(start, end, self.maxlen):
+                self.callback(data[i:min(i+self.maxlen, end)])
+
+    def partial(self, data, start):
+        """
+            Handles an incomplete line which already exceeds maxlen. Nothing
+            more than maxlen bytes is ever buffered.
+        """
+        self.overflows += 1
+        maxlen = self.maxlen
+        if self.overflow == 'split':
+            # report all full pieces, keep the remainder
+            end = len(data)
+            while end - start > maxlen:
+                self.callback(data[start:start+maxlen])
+                start += maxlen
+            self.buf = data[start:]
+            return
+
+        if self.overflow == 'truncate':
+            self.callback(data[start:start+maxlen])
+        # skip everything up to the next newline
+        self.discarding = True
+
+def FramerFromOptions(callback, opts):
+    """
+        Creates a LineFramer from the maxline and overflow input options.
+    """
+    try:
+        maxlen = int(opts.get('maxline', 4096))
+    except ValueError:
+        raise Exception("maxline option must be numeric")
+    return LineFramer(callback, maxlen, opts.get('overflow', 'split'))
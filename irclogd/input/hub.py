@@ -0,0 +1,171 @@
+"""
+    The input hub owns all sockets and fifos of the process. Every source is
+    opened once, no matter how many virtual users (on how many connections)
+    listen on it. Lines are framed once by the source and fanned out to all
+    subscriptions.
+"""
+
+from irclogd import metrics
+from irclogd.input import parseSize
+
+# all open sources, by key
+sources = { }
+
+# bytes a source reads at most per reactor iteration, unless it has a budget
+# option of its own. Whatever is left waits for the next iteration, so busy
+# sources take turns with each other and with the irc connections.
+budget = 16*1024
+
+def getSource(key):
+    return sources.get(key)
+
+class Source:
+    """
+        Base class for shared sources. Subclasses open their socket or fifo,
+        call register() once it is open and deliver() for every line. close()
+        must release the underlying resources, it is called when the last
+        subscription goes away, which is still subscribed at that point.
+
+        Reading should stop once budget bytes were read in one reactor
+        iteration, and call exhausted() if there was more.
+    """
+
+    def __init__(self, key, framer, opts = None):
+        self.key = key
+        self.framer = framer
+        self.opts = opts if opts is not None else { }
+        self.subscriptions = [ ]
+        self.pauses = 0
+        self.budget = parseSize(self.opts['budget']) if 'budget' in self.opts else budget
+        if self.budget < 1:
+            raise Exception("budget option must be positive")
+
+        # statistics
+        self.lines = 0
+        self.bytes = 0
+        self.deferrals = 0
+
+    def register(self):
+        sources[self.key] = self
+        metrics.register(self)
+
+    def unregister(self):
+        if sources.get(self.key) is self:
+            del sources[self.key]
+        metrics.unregister(self)
+
+    def subscribe(self, sub):
+        self.subscriptions.append(sub)
+
+    def unsubscribe(self, sub):
+        if sub not in self.subscriptions:
+            return
+        if sub.paused:
+            self.resume()
+
+        # last one turns out the lights
+        if len(self.subscriptions) == 1:
+            self.unregister()
+            self.close()
+        self.subscriptions.remove(sub)
+
+    def notice(self, msg):
+        for sub in self.subscriptions:
+            sub.user.notice(msg)
+
+    def deliver(self, line):
+        """
+            Hands a line to all subscriptions.
+        """
+        self.lines += 1
+        for sub in self.subscriptions:
+            sub.user.msg(line)
+
+    def exhausted(self):
+        """
+            Called when reading stopped with the budget spent.
+        """
+        self.deferrals += 1
+
+    def stats(self):
+        """
+            Returns a list of human readable statistic lines.
+        """
+        return [ "{}: {} bytes, {} lines, {} overlong lines, {} listeners".format(
+                self.name, self.bytes, self.lines, self.framer.overflows, len(self.subscriptions)),
+                "{}: read budget {} bytes per iteration, spent {} times".format(self.name, self.budget, self.deferrals) ]
+
+    def metrics(self):
+        labels = { 'input' : ':'.join(str(k) for k in self.key) }
+        yield "input_lines_total", "counter", labels, self.lines
+        yield "input_bytes_total", "counter", labels, self.bytes
+        yield "input_overlong_lines_total", "counter", labels, self.framer.overflows
+        yield "input_listeners", "gauge", labels, len(self.subscriptions)
+        yield "input_budget_exhausted_total", "counter", labels, self.deferrals
+
+    def pause(self):
+        self.pauses += 1
+        if self.pauses == 1:
+            self.pauseReading()
+
+    def resume(self):
+        self.pauses -= 1
+        if self.pauses == 0:
+            self.resumeReading()
+
+    def pauseReading(self):
+        raise NotImplementedError()
+
+    def resumeReading(self):
+        raise NotImplementedError()
+
+    def close(self):
+        raise NotImplementedError()
+
+class Subscription:
+    """
+        A virtual user's handle on a shared source. This is what ends up as
+        the input of an InputUser.
+    """
+
+    def __init__(self, source, user):
+        self.source = source
+        self.user = user
+        self.name = source.name
+        self.paused = False
+
+    def accepts(self, host, n = 1):
+        """
+            Whether n lines from host are for this subscription.
+        """
+        return True
+
+    def pauseProducing(self):
+        if not self.paused:
+            self.paused = True
+            self.source.pause()
+
+    def resumeProducing(self):
+        if self.paused:
+            self.paused = False
+            self.source.resume()
+
+    def stats(self):
+        return self.source.stats()
+
+    def destroy(self):
+        self.source.unsubscribe(self)
+
+def checkOptions(source, opts):
+    """
+        Framing and everything else configured by options happens once per
+        source, so all subscriptions must agree on the options.
+    """
+    maxlen = int(opts.get('maxline', source.framer.maxlen))
+    overflow = opts.get('overflow', source.framer.overflow)
+    if maxlen != source.framer.maxlen or overflow != source.framer.overflow:
+        raise Exception("Input is already open with maxline={} overflow={}".format(source.framer.maxlen, source.framer.overflow))
+
+    for key, value in opts.iteritems():
+        if key not in ('maxline', 'overflow') and source.opts.get(key) != value:
+            raise Exception("Input is already open with {}={}".format(key, source.opts.get(key)))
@@ -0,0 +1,149 @@
+"""
+    The registry of input sources. An input is a module defining factory, a
+    function (user, params) returning a subscription, and schema, the
+    Schema of its parameters.
+
+    Inputs are found by name, without importing anything: the ones shipped
+    with irclogd are listed in builtins and live in this package, others
+    are name.py files in the plugindir setting. A module is only imported
+    when an input of its kind is first asked for, and its parameters are
+    checked against its schema before the factory opens anything.
+"""
+
+import os
+import re
+import imp
+import importlib
+
+from irclogd.input import splitParams, parseSize
+
+builtins = ('udp', 'fifo', 'tcp', 'tail', 'syslog')
+
+validname = re.compile(r'^[a-z][a-z0-9_]*$')
+
+# imported inputs, by name
+loaded = { }
+
+class Schema:
+    """
+        The parameters of an input:
+            args: (name, type) of the positional arguments, in order
+            required: how many of them must be given, by default all
+            repeat: whether the last argument may be given any number of times
+            options: name -> type of the key=value options
+            rest: an option taking the rest of the line, spaces and all
+
+        A type is a function converting the string, which raises an
+        Exception if it is invalid, or a tuple of the allowed values. Every
+        input takes the common options: maxline and overflow of its framer,
+        and its read budget.
+    """
+
+    common = { 'maxline' : int, 'overflow' : ('split', 'truncate', 'drop'), 'budget' : parseSize }
+
+    def __init__(self, args, required = None, repeat = False, options = None, rest = None):
+        self.args = args
+        self.required = len(args) if required is None else required
+        self.repeat = repeat
+        self.options = dict(Schema.common, **(options or { }))
+        self.rest = rest
+
+    def usage(self):
+        words = [ ]
+        for i, (name, kind) in enumerate(self.args):
+            if self.repeat and i == len(self.args) - 1:
+                name += ' ..'
+            words.append(name if i < self.required else "[{}]".format(name))
+        words.append("[{}=..]".format('|'.join(sorted(self.options))))
+        if self.rest is not None:
+            words.append("[{}=...]".format(self.rest))
+        return ' '.join(words)
+
+    def validate(self, params):
+        """
+            Raises an Exception if params don't fit the schema.
+        """
+        if self.rest is not None:
+            for i, p in enumerate(params):
+                if p.startswith(self.rest + '='):
+                    params = params[:i]
+                    break
+
+        args, opts = splitParams(params)
+        if len(args) < self.required or (len(args) > len(self.args) and not self.repeat):
+            raise Exception("Usage: " + self.usage())
+
+        for i, value in enumerate(args):
+            name, kind = self.args[min(i, len(self.args) - 1)]
+            check(name, kind, value)
+
+        for key, value in opts.iteritems():
+            if key not in self.options:
+                raise Exception("Unknown option {}, known are {}".format(key, ', '.join(sorted(self.options))))
+            check(key, self.options[key], value)
+
+def check(name, kind, value):
+    if isinstance(kind, tuple):
+        if value not in kind:
+            raise Exception("{} must be one of {}".format(name, ', '.join(kind)))
+        return
+    try:
+        kind(value)
+    except Exception:
+        raise Exception("Invalid {}: {}".format(name, value))
+
+def find(name, plugindir = None):
+    """
+        Returns the path of the plugin module for name, None for a builtin,
+        or raises an Exception if there is no such input.
+    """
+    if validname.match(name):
+        if name in builtins:
+            return None
+        if plugindir is not None:
+            path = os.path.join(plugindir, name + ".py")
+            if os.path.isfile(path):
+                return path
+    raise Exception("Unknown input: {}, available are {}".format(name, ', '.join(available(plugindir))))
+
+def available(plugindir = None):
+    """
+        Returns the names of all inputs, builtin or in the plugindir.
+    """
+    names = list(builtins)
+    if plugindir is not None and os.path.isdir(plugindir):
+        for f in sorted(os.listdir(plugindir)):
+            if f.endswith(".py") and validname.match(f[:-3]) and f[:-3] not in names:
+                names.append(f[:-3])
+    return names
+
+def load(name, plugindir = None):
+    """
+        Returns the module of the named input, importing it first if this
+        is the first time it is asked for.
+    """
+    if name in loaded:
+        return loaded[name]
+
+    path = find(name, plugindir)
+    try:
+        if path is None:
+            module = importlib.import_module("irclogd.input." + name)
+        else:
+            module = imp.load_source("irclogd_plugin_" + name, path)
+    except Exception as e:
+        raise Exception("Failed loading input {}: {}".format(name, e))
+
+    if not callable(getattr(module, 'factory', None)) or not isinstance(getattr(module, 'schema', None), Schema):
+        raise Exception("Input {} defines no factory and schema".format(name))
+    loaded[name] = module
+    return module
+
+def create(user, params, plugindir = None):
+    """
+        Creates the input described by params, an input name followed by
+        its parameters, for user.
+    """
+    module = load(params[0], plugindir)
+    module.schema.validate(params[1:])
+    return module.factory(user, params[1:])
@@ -0,0 +1,350 @@
+import os
+import stat
+import time
+import errno
+import socket
+import string
+
+from twisted.internet import reactor, protocol, unix
+from twisted.python import log
+
+from irclogd import metrics
+from irclogd.input import splitParams, hub
+from irclogd.input.acl import HostSubscription
+from irclogd.input.framer import FramerFromOptions
+from irclogd.input.plugins import Schema
+from irclogd.input.udp import BudgetPort
+
+severities = ('emerg', 'alert', 'crit', 'err', 'warning', 'notice', 'info', 'debug')
+facilities = ('kern', 'user', 'mail', 'daemon', 'auth', 'syslog', 'lpr', 'news',
+        'uucp', 'cron', 'authpriv', 'ftp', 'ntp', 'audit', 'alert', 'clock',
+        'local0', 'local1', 'local2', 'local3', 'local4', 'local5', 'local6', 'local7')
+
+class Message(object):
+    """
+        A syslog message in RFC 3164 or RFC 5424 format, which is only parsed
+        as far as its fields are asked for. The priority is parsed on its
+        own, everything else at once on first access.
+    """
+    __slots__ = ('raw', 'source', 'pri', 'start', 'header')
+
+    def __init__(self, raw, source):
+        self.raw = raw
+        self.source = source
+        self.pri = None
+        self.header = None
+
+    def priority(self):
+        if self.pri is None:
+            raw = self.raw
+            end = raw.find('>', 1, 5) if raw[:1] == '<' else -1
+            try:
+                self.pri = int(raw[1:end])
+                self.start = end + 1
+            except ValueError:
+                # no priority at all, which makes it user.notice
+                self.pri = 13
+                self.start = 0
+        return self.pri
+
+    def severity(self):
+        return self.priority() & 7
+
+    def fields(self):
+        """
+            Returns (timestamp, host, app, pid, msg).
+        """
+        if self.header is None:
+            self.priority()
+            raw = self.raw.rstrip('\r\n\0')
+            if raw[self.start:self.start+2] == '1 ':
+                self.header = parse5424(raw, self.start)
+            else:
+                self.header = parse3164(raw, self.start)
+        return self.header
+
+def nil(value):
+    return '' if value == '-' else value
+
+def parse5424(raw, start):
+    """
+        <pri>1 timestamp host app procid msgid [structured data] msg
+    """
+    parts = raw[start:].split(' ', 6)
+    if len(parts) < 7:
+        parts.extend([ '' ] * (7 - len(parts)))
+    rest = parts[6]
+
+    # skip the structured data elements, which may contain escaped brackets
+    if rest[:1] == '-':
+        msg = rest[2:]
+    else:
+        i = 0
+        while rest[i:i+1] == '[':
+            j = rest.find(']', i)
+            while j > 0 and rest[j-1] == '\\':
+                j = rest.find(']', j+1)
+            if j < 0:
+                i = len(rest)
+                break
+            i = j + 1
+        msg = rest[i+1:]
+    if msg[:3] == '\xef\xbb\xbf':
+        msg = msg[3:]
+
+    return nil(parts[1]), nil(parts[2]), nil(parts[3]), nil(parts[4]), msg
+
+def parse3164(raw, start):
+    """
+        <pri>Mmm dd hh:mm:ss host tag[pid]: msg, where host is left out by
+        most local senders.
+    """
+    timestamp = ''
+    rest = raw[start:]
+    if rest[3:4] == ' ' and rest[6:7] == ' ' and rest[9:10] == ':':
+        timestamp = rest[:15]
+        rest = rest[16:]
+
+    host = ''
+    token, _, after = rest.partition(' ')
+    if not (token.endswith(':') or '[' in token):
+        tag, _, msg = after.partition(' ')
+        if tag.endswith(':') or '[' in tag:
+            host = token
+        else:
+            # no recognizable tag, the rest is all message
+            return timestamp, '', '', '', rest
+    else:
+        tag, msg = token, after
+
+    tag = tag.rstrip(':')
+    pid = ''
+    i = tag.find('[')
+    if i >= 0:
+        tag, pid = tag[:i], tag[i+1:].rstrip(']')
+    return timestamp, host, tag, pid, msg
+
+class Template:
+    """
+        A display format like "{severity} {host} {app}: {msg}". The fields it
+        uses are determined once, so formatting only parses what is needed.
+
+        Available fields: severity, facility, timestamp, host (the sender's
+        address if the message has none), source (the sender's address),
+        app, pid, msg and raw.
+    """
+
+    fieldnames = ('severity', 'facility', 'timestamp', 'host', 'source', 'app', 'pid', 'msg', 'raw')
+    headerfields = ('timestamp', 'host', 'app', 'pid', 'msg')
+
+    def __init__(self, fmt):
+        self.fmt = fmt
+        try:
+            used = [ f for literal, f, spec, conv in string.Formatter().parse(fmt) if f is not None ]
+        except ValueError as e:
+            raise Exception("Invalid format: " + str(e))
+        for f in used:
+            if f not in Template.fieldnames:
+                raise Exception("Unknown format field {{{}}}, use one of {}".format(f, ', '.join(Template.fieldnames)))
+        self.used = set(used)
+        self.header = bool(self.used.intersection(Template.headerfields))
+
+    def format(self, m):
+        values = { }
+        used = self.used
+        if self.header:
+            values['timestamp'], values['host'], values['app'], values['pid'], values['msg'] = m.fields()
+            if not values['host']:
+                values['host'] = m.source or 'localhost'
+        if 'severity' in used:
+            values['severity'] = severities[m.priority() & 7]
+        if 'facility' in used:
+            f = m.priority() >> 3
+            values['facility'] = facilities[f] if f < len(facilities) else str(f)
+        if 'source' in used:
+            values['source'] = m.source or 'localhost'
+        if 'raw' in used:
+            values['raw'] = m.raw
+        return self.fmt.format(**values)
+
+class BudgetUnixPort(unix.DatagramPort):
+    """
+        The unix datagram socket version of udp.BudgetPort.
+    """
+
+    def __init__(self, address, source, **kwargs):
+        unix.DatagramPort.__init__(self, address, source, **kwargs)
+        self.maxThroughput = source.budget
+
+    def doRead(self):
+        before = self.protocol.bytes
+        unix.DatagramPort.doRead(self)
+        if self.protocol.bytes - before >= self.maxThroughput:
+            self.protocol.exhausted()
+
+class SyslogSource(hub.Source, protocol.DatagramProtocol):
+    """
+        This source receives syslog messages on a udp port or a unix
+        datagram socket, one message per datagram, and reports them to every
+        subscription whose severity threshold they pass, in its format.
+    """
+    name = "syslog"
+
+    def __init__(self, address, opts):
+        hub.Source.__init__(self, ('syslog', address), FramerFromOptions(None, opts), opts)
+        self.address = address
+        self.listening = None
+        # device and inode of the socket we created, if it is a path
+        self.created = None
+
+        # statistics
+        self.messages = 0
+        self.filtered = 0
+
+    def listen(self):
+        if isinstance(self.address, int):
+            self.listening = BudgetPort(self.address, self, reactor=reactor)
+            self.listening.startListening()
+            self.notice("Receiving syslog on UDP port " + str(self.address))
+        else:
+            if os.path.exists(self.address):
+                self.removeStale()
+            self.listening = BudgetUnixPort(self.address, self, reactor=reactor)
+            self.listening.startListening()
+            st = os.stat(self.address)
+            self.created = (st.st_dev, st.st_ino)
+            self.notice("Receiving syslog on " + self.address)
+
+    def removeStale(self):
+        """
+            Removes the socket at our path if it is left over from a previous
+            run, which nobody receives on anymore. Raises an Exception if it
+            is still in use, or not a socket at all.
+        """
+        if not stat.S_ISSOCK(os.stat(self.address).st_mode):
+            raise Exception("Path in use: " + self.address)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.connect(self.address)
+        except socket.error as e:
+            if e.args[0] != errno.ECONNREFUSED:
+                raise Exception("Path in use: {}: {}".format(self.address, e))
+            os.unlink(self.address)
+            return
+        finally:
+            sock.close()
+        raise Exception("Path in use, someone receives on it: " + self.address)
+
+    def datagramReceived(self, data, addr):
+        self.messages += 1
+        self.bytes += len(data)
+
+        m = Message(data, addr[0] if isinstance(addr, tuple) else '')
+        framer = self.framer
+        delivered = False
+        metrics.received = time.time()
+        try:
+            for sub in self.subscriptions:
+                if m.severity() > sub.threshold or not sub.accepts(m.source):
+                    continue
+                delivered = True
+                # a failing subscription must not keep the message from the others
+                try:
+                    framer.callback = sub.user.msg
+                    framer.feed(sub.template.format(m))
+                    framer.flush()
+                except:
+                    framer.reset()
+                    log.err()
+        finally:
+            metrics.received = None
+        # each message counts once, however many subscriptions got it
+        if delivered:
+            self.lines += 1
+        else:
+            self.filtered += 1
+
+    def stats(self):
+        result = hub.Source.stats(self)
+        result.append("syslog {}: {} messages, {} filtered out".format(self.address, self.messages, self.filtered))
+        return result
+
+    def pauseReading(self):
+        self.transport.stopReading()
+
+    def resumeReading(self):
+        self.transport.startReading()
+
+    def close(self):
+        self.notice("Stopped receiving syslog on " + str(self.address))
+        self.listening.stopListening()
+        # only remove the socket if it is still the one we created
+        if self.created is not None:
+            try:
+                st = os.stat(self.address)
+            except OSError:
+                return
+            if (st.st_dev, st.st_ino) == self.created:
+                os.unlink(self.address)
+
+class SyslogInput(HostSubscription):
+    """
+        A subscription to a syslog source, with its own severity threshold
+        and format.
+    """
+
+    defaultFormat = "{severity} {host} {app}: {msg}"
+
+    def __init__(self, source, user, params, severity = 'debug', fmt = None):
+        if severity not in severities:
+            raise Exception("Unknown severity {}, use one of {}".format(severity, ', '.join(severities)))
+        self.threshold = severities.index(severity)
+        self.template = Template(fmt or SyslogInput.defaultFormat)
+        HostSubscription.__init__(self, source, user, params)
+
+def SyslogInputFactory(user, params):
+    # the format is the rest of the line, spaces and all
+    fmt = None
+    for i, p in enumerate(params):
+        if p.startswith('format='):
+            fmt = ' '.join(params[i:])[7:]
+            # params are unicode, while messages are formatted as bytes
+            if isinstance(fmt, unicode):
+                fmt = fmt.encode('utf-8')
+            params = params[:i]
+            break
+
+    params, opts = splitParams(params)
+    if len(params) == 0:
+        raise Exception("Syslog input requires a udp port or a socket path argument")
+    if params[0].isdigit():
+        address = int(params[0])
+    else:
+        address = os.path.realpath(params[0])
+    severity = opts.pop('severity', 'debug')
+
+    source = hub.getSource(('syslog', address))
+    if source is None:
+        source = SyslogSource(address, opts)
+        proto = SyslogInput(source, user, params[1:], severity, fmt)
+        source.subscribe(proto)
+        try:
+            source.listen()
+        except:
+            if proto.filter is not None:
+                proto.filter.stop()
+            raise
+        source.register()
+    else:
+        hub.checkOptions(source, opts)
+        user.notice("Sharing syslog {} with {} other listeners".format(address, len(source.subscriptions)))
+        proto = SyslogInput(source, user, params[1:], severity, fmt)
+        source.subscribe(proto)
+
+    if proto.acceptedHosts is not None:
+        user.notice("Accepted hosts: " + ', '.join(proto.acceptedHosts))
+    return proto
+
+schema = Schema([ ('address', str), ('hosts', str) ], required = 1, repeat = True,
+        options = { 'severity' : severities }, rest = 'format')
+factory = SyslogInputFactory
@@ -0,0 +1,252 @@
+import os
+import time
+import errno
+
+from twisted.internet import reactor, task, inotify
+from twisted.python.filepath import FilePath
+
+from irclogd import metrics
+from irclogd.logstore import quote
+from irclogd.input import splitParams, hub
+from irclogd.input.framer import FramerFromOptions
+from irclogd.input.plugins import Schema
+
+class TailSource(hub.Source):
+    """
+        This source follows a growing file, like tail -F.
+
+        The directory of the file is watched with inotify, so nothing
+        happens while the file is idle. When the file is written to, it is
+        read in chunks of chunksize bytes, at most the source's budget per
+        reactor iteration. If the file is renamed or deleted (rotated), the rest of
+        it is read once a new file appears under the same name, which is
+        then read from its start. If the file shrinks (truncated), it is read
+        from its start again.
+
+        With a statedir, the offset up to the last complete line is saved
+        every second and when irclogd stops, and reading resumes there after
+        a restart, as long as it is still the same file. If the file was
+        rotated or truncated meanwhile, it is read from its start. Without a
+        checkpoint, reading starts at the end of the file, or with from=start
+        at its beginning.
+
+        Rotations are noticed once the new file appears, the old file may
+        still be written to until then.
+
+        While the source is paused, nothing is read, the lines wait in the
+        file.
+    """
+    name = "tail"
+
+    chunksize = 256*1024
+    mask = inotify.IN_MODIFY | inotify.IN_CREATE | inotify.IN_MOVED_TO
+
+    def __init__(self, path, opts, statedir = None):
+        hub.Source.__init__(self, ('tail', path), FramerFromOptions(self.deliver, opts), opts)
+        if opts.get('from', 'end') not in ('start', 'end'):
+            raise Exception("from option must be start or end")
+
+        self.path = path
+        self.directory, self.filename = os.path.split(path)
+
+        self.fd = None
+        # device and inode of the open file, and where we are in it
+        self.file = None
+        self.offset = 0
+
+        self.state = None
+        if statedir is not None:
+            if not os.path.isdir(statedir):
+                os.makedirs(statedir)
+            self.state = os.path.join(statedir, "tail-" + quote(path))
+        self.saved = None
+
+        self.notifier = inotify.INotify()
+        self.readcall = None
+        self.checkpointcall = None
+        self.shutdown = None
+
+        # statistics
+        self.rotations = 0
+        self.truncations = 0
+
+    def start(self):
+        self.notifier.startReading()
+        self.notifier.watch(FilePath(self.directory), mask=TailSource.mask, callbacks=[ self.changed ])
+
+        self.open(self.resumeOffset)
+        self.notice("Following file: " + self.path)
+
+        if self.state is not None:
+            self.checkpointcall = task.LoopingCall(self.checkpoint)
+            self.checkpointcall.start(1, now=False)
+            self.shutdown = reactor.addSystemEventTrigger('before', 'shutdown', self.checkpoint)
+
+    def open(self, offset):
+        """
+            Opens the file, if it exists, and seeks to the offset returned by
+            offset(file, size).
+        """
+        try:
+            self.fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.fd = None
+            return
+
+        st = os.fstat(self.fd)
+        self.file = (st.st_dev, st.st_ino)
+        self.offset = offset(self.file, st.st_size)
+        os.lseek(self.fd, self.offset, os.SEEK_SET)
+        # whatever is there already is read once everyone is set up
+        self.readcall = reactor.callLater(0, self.read)
+
+    def resumeOffset(self, file, size):
+        """
+            Where to start reading when the source is created: at the
+            checkpoint if it is for this file, at the start if the checkpoint
+            is for a file rotated since, and at the end without one.
+        """
+        saved = self.load()
+        if saved is not None:
+            if saved[0] == file and saved[1] <= size:
+                return saved[1]
+            # everything in the new file was written after the checkpoint
+            return 0
+        return 0 if self.opts.get('from', 'end') == 'start' else size
+
+    def changed(self, ignored, path, mask):
+        if path.basename() != self.filename:
+            return
+
+        if mask & inotify.IN_MODIFY:
+            self.read()
+        elif mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+            # a new file took the place of the old one, finish the old one
+            if self.fd is not None:
+                self.read(drain=True)
+                self.framer.flush()
+                os.close(self.fd)
+                self.fd = None
+                self.rotations += 1
+            self.open(lambda file, size: 0)
+
+    def read(self, drain = False):
+        """
+            Reads up to budget bytes, and continues in the next reactor
+            iteration if there is more. With drain, everything is read.
+        """
+        if self.readcall is not None:
+            if self.readcall.active():
+                self.readcall.cancel()
+            self.readcall = None
+
+        if self.fd is None or (self.pauses > 0 and not drain):
+            return
+
+        if os.fstat(self.fd).st_size < self.offset:
+            self.truncations += 1
+            self.notice("File was truncated: " + self.path)
+            self.framer.reset()
+            self.offset = os.lseek(self.fd, 0, os.SEEK_SET)
+
+        metrics.received = time.time()
+        read = 0
+        size = TailSource.chunksize if drain else min(TailSource.chunksize, self.budget)
+        while drain or read < self.budget:
+            data = os.read(self.fd, size)
+            if not data:
+                break
+            read += len(data)
+            self.offset += len(data)
+            self.bytes += len(data)
+            self.framer.feed(data)
+        else:
+            self.exhausted()
+            self.readcall = reactor.callLater(0, self.read)
+        metrics.received = None
+
+    # checkpoints
+
+    def load(self):
+        """
+            Returns the saved ((device, inode), offset), or None.
+        """
+        if self.state is None:
+            return None
+        try:
+            with open(self.state) as f:
+                dev, ino, offset = [ int(v) for v in f.read().split() ]
+        except (IOError, ValueError):
+            return None
+        return (dev, ino), offset
+
+    def checkpoint(self):
+        """
+            Saves the offset after the last complete line, if it changed.
+        """
+        if self.state is None or self.file is None:
+            return
+        saved = (self.file, self.offset - len(self.framer.buf))
+        if saved == self.saved:
+            return
+        tmp = self.state + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write("{} {} {}\n".format(saved[0][0], saved[0][1], saved[1]))
+        os.rename(tmp, self.state)
+        self.saved = saved
+
+    def stats(self):
+        result = hub.Source.stats(self)
+        result.append("tail {}: at offset {}{}, {} rotations, {} truncations".format(
+                self.path, self.offset, "" if self.fd is not None else " (waiting for the file)",
+                self.rotations, self.truncations))
+        return result
+
+    def pauseReading(self):
+        pass
+
+    def resumeReading(self):
+        self.read()
+
+    def close(self):
+        if self.readcall is not None and self.readcall.active():
+            self.readcall.cancel()
+        self.readcall = None
+        if self.checkpointcall is not None:
+            self.checkpointcall.stop()
+            reactor.removeSystemEventTrigger(self.shutdown)
+        self.checkpoint()
+        self.notifier.loseConnection()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.notice("Stopped following file: " + self.path)
+
+def TailInputFactory(user, params):
+    params, opts = splitParams(params)
+
+    if len(params) != 1:
+        raise Exception("Tail input requires exactly one path argument")
+    path = os.path.realpath(params[0])
+    if not os.path.isdir(os.path.dirname(path)):
+        raise Exception("Directory of the path argument does not exist!")
+
+    source = hub.getSource(('tail', path))
+    if source is not None:
+        hub.checkOptions(source, opts)
+        user.notice("Sharing file {} with {} other readers".format(path, len(source.subscriptions)))
+        proto = hub.Subscription(source, user)
+        source.subscribe(proto)
+        return proto
+
+    source = TailSource(path, opts, getattr(user.server.factory, 'statedir', None))
+    proto = hub.Subscription(source, user)
+    source.subscribe(proto)
+    source.start()
+    source.register()
+    return proto
+
+schema = Schema([ ('path', str) ], options = { 'from' : ('start', 'end') })
+factory = TailInputFactory
@@ -0,0 +1,220 @@
+import time
+
+from twisted.internet import reactor, protocol
+from twisted.protocols import policies
+
+from irclogd import metrics
+from irclogd.flood import TokenBucket
+from irclogd.input import splitParams, hub
+from irclogd.input.acl import HostSubscription
+from irclogd.input.framer import FramerFromOptions
+from irclogd.input.plugins import Schema
+
+class TcpConnection(protocol.Protocol, policies.TimeoutMixin):
+    """
+        One sender connected to a tcp source. Every connection has its own
+        framer, lines never continue from one connection into another.
+
+        Reading is paused while the source is paused, and, with a rate
+        limit, for as long as it takes to pay off the lines read beyond it.
+        Either way, the sender is slowed down by tcp flow control rather
+        than losing lines.
+    """
+
+    def __init__(self, source, host):
+        self.source = source
+        self.host = host
+        self.framer = FramerFromOptions(None, source.opts)
+        self.bucket = TokenBucket(source.rate, source.rate) if source.rate else None
+        self.throttled = False
+        self.throttlecall = None
+
+    def connectionMade(self):
+        self.source.connections.append(self)
+        # a connection is read one buffer per reactor iteration
+        self.transport.bufferSize = min(self.transport.bufferSize, self.source.budget)
+        self.updateReading()
+
+    def dataReceived(self, data):
+        self.resetTimeout()
+        self.source.bytes += len(data)
+        if len(data) >= self.transport.bufferSize:
+            self.source.exhausted()
+
+        lines = [ ]
+        self.framer.callback = lines.append
+        self.framer.feed(data)
+        self.deliver(lines)
+
+        if self.bucket is not None and lines:
+            wait = self.bucket.spend(len(lines))
+            if wait > 0:
+                self.throttle(wait)
+
+    def deliver(self, lines):
+        if not lines:
+            return
+        self.source.lines += len(lines)
+        receivers = [ sub.user.msg for sub in self.source.subscriptions if sub.accepts(self.host, len(lines)) ]
+        metrics.received = time.time()
+        for line in lines:
+            for msg in receivers:
+                msg(line)
+        metrics.received = None
+
+    def throttle(self, wait):
+        self.source.throttled += 1
+        self.throttled = True
+        self.updateReading()
+        self.throttlecall = reactor.callLater(wait, self.unthrottle)
+
+    def unthrottle(self):
+        self.throttlecall = None
+        self.throttled = False
+        self.updateReading()
+
+    def updateReading(self):
+        """
+            Pauses or resumes reading from the sender. The idle timeout does
+            not run while we are the ones not reading.
+        """
+        if self.throttled or self.source.pauses > 0:
+            self.transport.pauseProducing()
+            self.setTimeout(None)
+        else:
+            self.transport.resumeProducing()
+            self.setTimeout(self.source.idle or None)
+
+    def timeoutConnection(self):
+        self.source.timeouts += 1
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.setTimeout(None)
+        if self.throttlecall is not None:
+            self.throttlecall.cancel()
+            self.throttlecall = None
+        # the sender is gone, report what is left of the last line
+        lines = [ ]
+        self.framer.callback = lines.append
+        self.framer.flush()
+        self.deliver(lines)
+        self.source.framer.overflows += self.framer.overflows
+        if self in self.source.connections:
+            self.source.connections.remove(self)
+
+class TcpSource(hub.Source, protocol.ServerFactory):
+    """
+        This source listens on a given tcp port, accepting any number of
+        senders up to maxconns, and reports their lines to the subscribed
+        users.
+
+        Connections from hosts no subscription accepts are closed right
+        away. With the idle option, connections which sent nothing for that
+        many seconds are closed. The rate option limits the lines per second
+        read from each connection.
+    """
+    name = "tcp"
+
+    def __init__(self, port, opts):
+        # connections frame on their own, this one only holds the options
+        hub.Source.__init__(self, ('tcp', port), FramerFromOptions(None, opts), opts)
+        self.port = port
+        self.listening = None
+        self.connections = [ ]
+
+        try:
+            self.maxconns = int(opts.get('maxconns', 256))
+            self.idle = float(opts.get('idle', 300))
+            self.rate = float(opts.get('rate', 0))
+        except ValueError:
+            raise Exception("maxconns, idle and rate options must be numeric")
+
+        # statistics
+        self.accepted = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.throttled = 0
+
+    def listen(self):
+        self.listening = reactor.listenTCP(self.port, self)
+        self.notice("Started listening on TCP port " + str(self.port))
+
+    def buildProtocol(self, addr):
+        if len(self.connections) >= self.maxconns:
+            self.rejected += 1
+            return None
+        # a sender nobody listens to is turned away, not ignored
+        if not any(sub.accepts(addr.host, 0) for sub in self.subscriptions):
+            self.rejected += 1
+            return None
+        self.accepted += 1
+        return TcpConnection(self, addr.host)
+
+    def stats(self):
+        result = hub.Source.stats(self)
+        result.append("tcp port {}: {} of {} connections, {} accepted, {} rejected, {} timed out, {} throttled".format(
+                self.port, len(self.connections), self.maxconns, self.accepted, self.rejected, self.timeouts, self.throttled))
+        return result
+
+    def metrics(self):
+        for m in hub.Source.metrics(self):
+            yield m
+        labels = { 'input' : 'tcp:{}'.format(self.port) }
+        yield "tcp_connections", "gauge", labels, len(self.connections)
+        yield "tcp_rejected_connections_total", "counter", labels, self.rejected
+        yield "tcp_throttled_total", "counter", labels, self.throttled
+
+    def pauseReading(self):
+        for c in self.connections:
+            c.updateReading()
+
+    def resumeReading(self):
+        for c in self.connections:
+            c.updateReading()
+
+    def close(self):
+        self.notice("Stopped listening on TCP port " + str(self.port))
+        if self.listening is not None:
+            self.listening.stopListening()
+        for c in list(self.connections):
+            c.transport.loseConnection()
+
+class TcpInput(HostSubscription):
+    """
+        A subscription to a tcp port, optionally only for some sending hosts.
+    """
+
+def TcpInputFactory(user, params):
+    params, opts = splitParams(params)
+    try:
+        port = int(params[0])
+    except:
+        raise Exception("Tcp input requires one numeric port argument")
+
+    source = hub.getSource(('tcp', port))
+    if source is None:
+        source = TcpSource(port, opts)
+        # this may fail on invalid hosts, before anything is opened
+        proto = TcpInput(source, user, params[1:])
+        source.subscribe(proto)
+        try:
+            source.listen()
+        except:
+            if proto.filter is not None:
+                proto.filter.stop()
+            raise
+        source.register()
+    else:
+        hub.checkOptions(source, opts)
+        user.notice("Sharing TCP port {} with {} other listeners".format(port, len(source.subscriptions)))
+        proto = TcpInput(source, user, params[1:])
+        source.subscribe(proto)
+
+    if proto.acceptedHosts is not None:
+        user.notice("Accepted hosts: " + ', '.join(proto.acceptedHosts))
+    return proto
+
+schema = Schema([ ('port', int), ('hosts', str) ], required = 1, repeat = True,
+        options = { 'maxconns' : int, 'idle' : float, 'rate' : float })
+factory = TcpInputFactory
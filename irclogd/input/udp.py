@@ -1,50 +1,318 @@
+import os
+import time
+import errno
+import socket
 
-from twisted.internet import reactor, protocol
+from twisted.internet import reactor, protocol, udp
+from twisted.python import log
 
-class UdpInput(protocol.DatagramProtocol):
+from irclogd import metrics
+from irclogd.input import splitParams, parseSize, hub
+from irclogd.input.acl import HostSubscription
+from irclogd.input.framer import FramerFromOptions
+from irclogd.input.plugins import Schema
+from irclogd.input.worker import WorkerSource, parseWorkers
+
+# SO_RCVBUFFORCE is missing from the socket module, it may exceed rmem_max
+SO_RCVBUFFORCE = 33
+
+def setReceiveBuffer(sock, size):
     """
-        This input class listens on a given udp port, reporting all received
-        messages.
+        Sets the kernel receive buffer size, beyond rmem_max if we are
+        allowed to.
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, size)
+    except socket.error:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
 
-        If a list of hosts is given as optional parameter, all messages from
-        hosts not on this list will be ignored.
+class BudgetPort(udp.Port):
+    """
+        A udp port which reads up to its source's budget per wakeup, and
+        tells the source when that was spent.
+    """
+
+    def __init__(self, port, source, **kwargs):
+        udp.Port.__init__(self, port, source, **kwargs)
+        self.maxThroughput = source.budget
+
+    def doRead(self):
+        before = self.protocol.bytes
+        udp.Port.doRead(self)
+        if self.protocol.bytes - before >= self.maxThroughput:
+            self.protocol.exhausted()
+
+class BatchPort(BudgetPort):
+    """
+        A udp port which drains up to maxBatch datagrams or its source's
+        budget per wakeup, and hands them to the protocol's
+        datagramsReceived as one list of (data, host) tuples.
+    """
+
+    maxBatch = 1024
+
+    def doRead(self):
+        batch = [ ]
+        read = 0
+        recvfrom = self.socket.recvfrom
+        size = self.maxPacketSize
+        while len(batch) < self.maxBatch and read < self.maxThroughput:
+            try:
+                data, addr = recvfrom(size)
+            except socket.error as se:
+                if se.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, errno.ECONNREFUSED):
+                    break
+                raise
+            batch.append((data, addr[0]))
+            read += len(data)
+        else:
+            self.protocol.exhausted()
+
+        if batch:
+            # like udp.Port, don't let a failure downstream close the port
+            try:
+                self.protocol.datagramsReceived(batch)
+            except:
+                log.err()
+
+class UdpSource(hub.Source, protocol.DatagramProtocol):
+    """
+        This source listens on a given udp port, reporting all received
+        messages to the subscribed users.
+
+        Every datagram is framed on its own, a line never continues into the
+        next datagram.
+
+        With the mode=batch option, the socket is drained in batches of many
+        datagrams per wakeup. The rcvbuf option sets the size of the kernel
+        receive buffer, which takes the bursts between wakeups.
     """
     name = "udp"
 
-    def __init__(self, user, port, params):
-        self.user = user
+    def __init__(self, port, opts):
+        hub.Source.__init__(self, ('udp', port), FramerFromOptions(self.emit, opts), opts)
         self.port = port
-        self.acceptedHosts = None
 
-        if len(params) > 0:
-            self.acceptedHosts = params
+        # receivers of the datagram currently being framed
+        self.receivers = [ ]
 
-    def startProtocol(self):
-        self.user.notice("Started listening on UDP port " + str(self.port))
-        if self.acceptedHosts is not None:
-            self.user.notice("Accepted hosts: " + ', '.join(self.acceptedHosts))
+        # statistics
+        self.datagrams = 0
+        self.rejected = 0
+        self.batches = 0
 
-    def stopProtocol(self):
-        self.user.notice("Stopped listening on UDP port " + str(self.port))
+    def startProtocol(self):
+        self.notice("Started listening on UDP port " + str(self.port))
 
     def datagramReceived(self, data, (host, port)):
-        if self.acceptedHosts is not None and host not in self.acceptedHosts:
+        self.datagrams += 1
+        self.bytes += len(data)
+
+        self.receivers = [ sub.user.msg for sub in self.subscriptions if sub.accepts(host) ]
+        if len(self.receivers) == 0:
+            self.rejected += 1
             return
 
-        lines = data.split("\n")
-        for l in lines:
-            if len(l) > 0:
-                self.user.msg(l)
+        metrics.received = time.time()
+        self.framer.feed(data)
+        self.framer.flush()
+        metrics.received = None
+
+    def datagramsReceived(self, batch):
+        """
+            Called by BatchPort with a list of (data, host) tuples. The
+            receivers are only looked up once per sending host.
+        """
+        self.batches += 1
+        self.datagrams += len(batch)
+
+        counts = { }
+        for data, host in batch:
+            counts[host] = counts.get(host, 0) + 1
+
+        receivers = { }
+        for host, n in counts.iteritems():
+            receivers[host] = [ sub.user.msg for sub in self.subscriptions if sub.accepts(host, n) ]
+            if len(receivers[host]) == 0:
+                self.rejected += n
+
+        metrics.received = time.time()
+        feed = self.framer.feed
+        flush = self.framer.flush
+        for data, host in batch:
+            self.bytes += len(data)
+            self.receivers = receivers[host]
+            if len(self.receivers) == 0:
+                continue
+            feed(data)
+            flush()
+        metrics.received = None
 
-    def destroy(self):
-        self.transport.loseConnection()
+    def emit(self, line):
+        self.lines += 1
+        for msg in self.receivers:
+            msg(line)
 
-def UdpInputFactory(channel, params):
+    def setReceiveBuffer(self, size):
+        setReceiveBuffer(self.transport.socket, size)
+
+    def kernelStats(self):
+        """
+            Returns (queued bytes, dropped datagrams) for our socket from
+            /proc/net/udp, or None if it can't be found.
+        """
+        inode = str(os.fstat(self.transport.socket.fileno()).st_ino)
+        for path in ('/proc/net/udp', '/proc/net/udp6'):
+            try:
+                f = open(path)
+            except IOError:
+                continue
+            try:
+                f.readline()
+                for l in f:
+                    fields = l.split()
+                    if len(fields) >= 13 and fields[9] == inode:
+                        return int(fields[4].split(':')[1], 16), int(fields[12])
+            finally:
+                f.close()
+        return None
+
+    def stats(self):
+        result = hub.Source.stats(self)
+        result.append("udp port {}: {} datagrams, {} rejected by host{}, receive buffer {} bytes".format(
+                self.port, self.datagrams, self.rejected,
+                ", {} batches".format(self.batches) if self.batches else "",
+                self.transport.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)))
+        kernel = self.kernelStats()
+        if kernel is not None:
+            result.append("udp port {}: kernel has {} bytes queued, dropped {} datagrams".format(self.port, kernel[0], kernel[1]))
+        return result
+
+    def metrics(self):
+        for m in hub.Source.metrics(self):
+            yield m
+        labels = { 'input' : 'udp:{}'.format(self.port) }
+        yield "udp_datagrams_total", "counter", labels, self.datagrams
+        yield "udp_rejected_datagrams_total", "counter", labels, self.rejected
+        kernel = self.kernelStats()
+        if kernel is not None:
+            yield "udp_kernel_queued_bytes", "gauge", labels, kernel[0]
+            yield "udp_kernel_dropped_datagrams_total", "counter", labels, kernel[1]
+
+    def pauseReading(self):
+        self.transport.stopReading()
+
+    def resumeReading(self):
+        self.transport.startReading()
+
+    def close(self):
+        self.notice("Stopped listening on UDP port " + str(self.port))
+        self.transport.stopListening()
+
+class UdpWorkerSource(WorkerSource):
+    """
+        A udp port read by several worker processes. The port is bound here
+        and the socket handed to every worker as fd 3, so datagrams arriving
+        while a worker is restarted wait in the socket instead of being lost.
+        Each datagram is read by one worker. Listening is only announced once
+        all workers reported they are ready, since senders waiting for that
+        could overrun the socket's buffer while the workers start up.
+    """
+    name = "udp"
+
+    def __init__(self, port, count, rcvbuf, opts):
+        framer = FramerFromOptions(None, opts)
+        args = [ 'udp', str(port), str(framer.maxlen), framer.overflow ]
+        WorkerSource.__init__(self, ('udp', port), framer, args, count, opts)
+        self.port = port
+        self.rcvbuf = rcvbuf
+        self.socket = None
+
+    def childFDs(self):
+        fds = WorkerSource.childFDs(self)
+        fds[3] = self.socket.fileno()
+        return fds
+
+    def start(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            if self.rcvbuf is not None:
+                setReceiveBuffer(sock, self.rcvbuf)
+            sock.bind(('', self.port))
+        except socket.error as e:
+            sock.close()
+            raise Exception("Could not listen on UDP port {}: {}".format(self.port, e))
+        self.socket = sock
+        WorkerSource.start(self)
+
+    def started(self):
+        self.notice("Started listening on UDP port {} with {} workers".format(self.port, len(self.workers)))
+
+    def close(self):
+        self.notice("Stopped listening on UDP port " + str(self.port))
+        WorkerSource.close(self)
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+class UdpInput(HostSubscription):
+    """
+        A subscription to a udp port, optionally only for some sending hosts.
+    """
+
+def UdpInputFactory(user, params):
+    params, opts = splitParams(params)
     try:
         port = int(params[0])
     except:
         raise Exception("Udp input requires one numeric port argument")
+
+    if opts.get('mode', 'default') not in ('default', 'batch'):
+        raise Exception("Unknown udp mode: " + opts['mode'])
+    rcvbuf = parseSize(opts['rcvbuf']) if 'rcvbuf' in opts else None
+    workers = parseWorkers(opts)
+
+    source = hub.getSource(('udp', port))
+    if source is None and workers is not None:
+        source = UdpWorkerSource(port, workers, rcvbuf, opts)
+        proto = UdpInput(source, user, params[1:])
+        source.subscribe(proto)
+        try:
+            source.start()
+        except:
+            if proto.filter is not None:
+                proto.filter.stop()
+            raise
+        source.register()
+    elif source is None:
+        source = UdpSource(port, opts)
+        # this may fail on invalid hosts, before anything is opened
+        proto = UdpInput(source, user, params[1:])
+        source.subscribe(proto)
+        try:
+            if opts.get('mode') == 'batch':
+                p = BatchPort(port, source, reactor=reactor)
+                p.startListening()
+            else:
+                p = BudgetPort(port, source, reactor=reactor)
+                p.startListening()
+        except:
+            if proto.filter is not None:
+                proto.filter.stop()
+            raise
+        if rcvbuf is not None:
+            source.setReceiveBuffer(rcvbuf)
+        source.register()
     else:
-        proto = UdpInput(channel, port, params[1:])
-        reactor.listenUDP(port, proto)
-        return proto
+        hub.checkOptions(source, opts)
+        user.notice("Sharing UDP port {} with {} other listeners".format(port, len(source.subscriptions)))
+        proto = UdpInput(source, user, params[1:])
+        source.subscribe(proto)
+
+    if proto.acceptedHosts is not None:
+        user.notice("Accepted hosts: " + ', '.join(proto.acceptedHosts))
+    return proto
+
+schema = Schema([ ('port', int), ('hosts', str) ], required = 1, repeat = True,
+        options = { 'mode' : ('default', 'batch'), 'rcvbuf' : parseSize, 'workers' : int })
+factory = UdpInputFactory
@@ -0,0 +1,313 @@
+"""
+    Ingestion in worker processes. With the workers=N option, an input is
+    not read by the irc process itself. Instead, N worker processes read and
+    frame the lines, and send them in batches over a pipe, so the irc process
+    only has to hand them to the subscriptions.
+
+    A batch is one record per sending host:
+        !HIH header: length of host, length of payload, overlong lines
+        host
+        payload: the framed lines, separated by newlines
+    A worker which is ready to read sends a lone header with the host
+    length set to ready.
+
+    The workers are run as "python -m irclogd.input.worker kind target
+    maxline overflow [persist]". The irc process restarts them if they die.
+    A udp port is bound by the irc process, its workers read the socket they
+    are given as fd 3.
+"""
+
+import os
+import sys
+import time
+import errno
+import struct
+import socket
+
+from twisted.internet import reactor, protocol, error
+
+from irclogd import metrics
+from irclogd.input import hub
+from irclogd.input.framer import LineFramer
+
+header = struct.Struct("!HIH")
+# the host length of the record announcing a worker is ready
+ready = 0xffff
+
+# directory containing the irclogd package, for the workers' python path
+root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class Worker(protocol.ProcessProtocol):
+    """
+        The irc process' end of one worker process.
+    """
+
+    def __init__(self, source, index):
+        self.source = source
+        self.index = index
+        self.buf = ''
+        self.started = time.time()
+
+    def outReceived(self, data):
+        if self.buf:
+            data = self.buf + data
+        start = 0
+        end = len(data)
+        received = self.source.received
+        while end - start >= header.size:
+            hostlen, length, overflows = header.unpack_from(data, start)
+            i = start + header.size
+            if hostlen == ready:
+                self.source.workerReady(self)
+                start = i
+                continue
+            if end - i < hostlen + length:
+                break
+            received(data[i:i+hostlen], data[i+hostlen:i+hostlen+length], overflows)
+            start = i + hostlen + length
+        self.buf = data[start:]
+
+    def errReceived(self, data):
+        for l in data.splitlines():
+            self.source.notice("Worker {}: {}".format(self.index, l))
+
+    def processEnded(self, reason):
+        self.source.workerEnded(self, getattr(reason.value, 'exitCode', None))
+
+class WorkerSource(hub.Source):
+    """
+        A source read by worker processes. Subclasses give the arguments for
+        the workers, and set endsOnExit if a worker exiting cleanly means
+        the input is done, rather than something to recover from.
+
+        Workers which die are restarted after a second, doubling the delay
+        up to maxdelay seconds for workers which keep dying right away.
+    """
+
+    endsOnExit = False
+    maxdelay = 30
+
+    def __init__(self, key, framer, args, count, opts):
+        hub.Source.__init__(self, key, framer, opts)
+        self.args = args
+        self.workers = [ None ] * count
+        self.delays = [ 1 ] * count
+        self.restartcalls = { }
+        self.closing = False
+        self.shutdown = None
+        # workers which didn't report they are ready since the start
+        self.starting = set(xrange(count))
+
+        # statistics
+        self.restarts = 0
+
+    def start(self):
+        for i in xrange(len(self.workers)):
+            self.spawn(i)
+        # the workers don't outlive us
+        self.shutdown = reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def spawn(self, i):
+        self.restartcalls.pop(i, None)
+        worker = Worker(self, i)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(p for p in (root, os.environ.get('PYTHONPATH')) if p))
+        args = [ sys.executable, '-m', 'irclogd.input.worker' ] + self.args
+        reactor.spawnProcess(worker, sys.executable, args, env=env, childFDs=self.childFDs())
+        self.workers[i] = worker
+        if self.pauses > 0:
+            worker.transport.pauseProducing()
+
+    def childFDs(self):
+        """
+            Returns the file descriptors of a worker, as for spawnProcess.
+        """
+        return { 0 : 'w', 1 : 'r', 2 : 'r' }
+
+    def workerReady(self, worker):
+        """
+            Called when a worker reports it is reading. Once all of them did
+            after the start, started() is called.
+        """
+        if worker.index in self.starting:
+            self.starting.discard(worker.index)
+            if not self.starting:
+                self.started()
+
+    def started(self):
+        pass
+
+    def received(self, host, payload, overflows):
+        lines = payload.split('\n')
+        self.lines += len(lines)
+        self.bytes += len(payload)
+        self.framer.overflows += overflows
+
+        receivers = [ sub.user.msg for sub in self.subscriptions if sub.accepts(host, len(lines)) ]
+        if len(receivers) == 0:
+            return
+
+        metrics.received = time.time()
+        for line in lines:
+            for msg in receivers:
+                msg(line)
+        metrics.received = None
+
+    def workerEnded(self, worker, code):
+        if self.closing or self.workers[worker.index] is not worker:
+            return
+        self.workers[worker.index] = None
+
+        if code == 0 and self.endsOnExit:
+            if not any(self.workers):
+                self.unregister()
+            return
+
+        # a worker which ran for a while gets a fresh delay
+        i = worker.index
+        if time.time() - worker.started > self.maxdelay:
+            self.delays[i] = 1
+        self.notice("Worker {} exited with code {}, restarting in {}s".format(i, code, self.delays[i]))
+        self.restarts += 1
+        self.restartcalls[i] = reactor.callLater(self.delays[i], self.spawn, i)
+        self.delays[i] = min(self.delays[i] * 2, self.maxdelay)
+
+    def stats(self):
+        result = hub.Source.stats(self)
+        result.append("{}: {} of {} workers running, {} restarts".format(
+                self.name, len([ w for w in self.workers if w is not None ]), len(self.workers), self.restarts))
+        return result
+
+    def pauseReading(self):
+        for w in self.workers:
+            if w is not None:
+                w.transport.pauseProducing()
+
+    def resumeReading(self):
+        for w in self.workers:
+            if w is not None:
+                w.transport.resumeProducing()
+
+    def close(self):
+        self.closing = True
+        if self.shutdown is not None:
+            reactor.removeSystemEventTrigger(self.shutdown)
+            self.shutdown = None
+        for call in self.restartcalls.itervalues():
+            call.cancel()
+        self.restartcalls = { }
+        for w in self.workers:
+            if w is not None:
+                try:
+                    w.transport.signalProcess('TERM')
+                except error.ProcessExitedAlready:
+                    pass
+
+def parseWorkers(opts):
+    """
+        Returns the number of workers given by the workers option, or None.
+    """
+    if 'workers' not in opts:
+        return None
+    try:
+        count = int(opts['workers'])
+    except ValueError:
+        count = 0
+    if count < 1:
+        raise Exception("workers option must be a positive number")
+    return count
+
+# the worker side
+
+class Batch:
+    """
+        Collects framed lines per host, and writes them as records.
+    """
+
+    def __init__(self, out, framer):
+        self.out = out
+        self.framer = framer
+        self.hosts = { }
+        self.overflows = framer.overflows
+
+    def add(self, host, data):
+        lines = self.hosts.get(host)
+        if lines is None:
+            lines = self.hosts[host] = [ ]
+        self.framer.callback = lines.append
+        self.framer.feed(data)
+
+    def write(self):
+        records = [ ]
+        overflows = self.framer.overflows - self.overflows
+        for host, lines in self.hosts.iteritems():
+            if lines:
+                payload = '\n'.join(lines)
+                records.append(header.pack(len(host), len(payload), min(overflows, 0xffff)) + host + payload)
+                overflows = 0
+        if records:
+            self.out.write(''.join(records))
+        self.hosts = { }
+        self.overflows = self.framer.overflows
+
+def readUdp(fd, framer, out, maxbatch = 1024):
+    sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_DGRAM)
+    os.close(fd)
+    out.write(header.pack(ready, 0, 0))
+
+    batch = Batch(out, framer)
+    while True:
+        # block for the first datagram, then drain whatever else is there
+        data, addr = sock.recvfrom(65536)
+        batch.add(addr[0], data)
+        framer.flush()
+        for i in xrange(maxbatch - 1):
+            try:
+                data, addr = sock.recvfrom(65536, socket.MSG_DONTWAIT)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                raise
+            batch.add(addr[0], data)
+            framer.flush()
+        batch.write()
+
+def readFifo(path, framer, out, persist = 'none', chunksize = 65536):
+    fd = os.open(path, os.O_RDONLY)
+    if persist == 'hold':
+        # the fifo never ends while we hold a writer ourselves
+        writefd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+    batch = Batch(out, framer)
+    while True:
+        data = os.read(fd, chunksize)
+        if not data:
+            # the writer is gone, report what is left of the last line
+            batch.hosts[''] = [ ]
+            framer.callback = batch.hosts[''].append
+            framer.flush()
+            batch.write()
+            if persist != 'reopen':
+                return
+            # blocks until the next writer comes along
+            os.close(fd)
+            fd = os.open(path, os.O_RDONLY)
+            continue
+        batch.add('', data)
+        batch.write()
+
+def main(args):
+    kind, target, maxline, overflow = args[:4]
+    framer = LineFramer(None, int(maxline), overflow)
+    out = os.fdopen(1, 'wb', 0)
+    try:
+        if kind == 'udp':
+            readUdp(3, framer, out)
+        else:
+            readFifo(target, framer, out, args[4] if len(args) > 4 else 'none')
+    except KeyboardInterrupt:
+        pass
+    except (socket.error, OSError, IOError) as e:
+        print >> sys.stderr, str(e)
+        sys.exit(2)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
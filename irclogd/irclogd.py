@@ -1,21 +1,95 @@
 #!/usr/bin/env python
 
 import sys
+import re
 from datetime import datetime
 import time
 
 from twisted.words.protocols import irc
-from twisted.internet import reactor, protocol
+from twisted.internet import reactor, protocol, task
 
 import user
+import config
+import scrollback
+import logstore
+import metrics
+import trace
+from input import hub
+from output import OutputQueue
+from dedup import DedupWindowFromParams
 
 # add missing numeric reply
 irc.RPL_CREATIONTIME = "329"
 
 
 port = 6700
+# print every trace record as it is recorded
 debug = True
 
+# maximum number of lines per write, and seconds to wait before writing
+batchsize = 1024
+flushinterval = 0
+
+# bounds of the bulk lane of the outgoing queue, and what to do once they are
+# reached: drop-oldest, drop-newest or pause (the inputs)
+queuelines = 10000
+queuebytes = 4*1024*1024
+queuepolicy = 'drop-oldest'
+# interval in seconds in which dropped lines are reported to the channels
+dropreport = 30
+
+# lines and bytes of scrollback kept per channel and replayed on JOIN (0 to
+# disable), and the memory limit for the scrollback of all channels together
+scrollbacklines = 0
+scrollbackbytes = 256*1024
+scrollbackmemory = 64*1024*1024
+
+# directory to keep the history of all channels in (None to disable), size
+# and age in seconds after which log segments are rotated, seconds between
+# syncs to disk, and the maximum number of lines shown by history and grep
+logdir = None
+logsegmentsize = 16*1024*1024
+logsegmentage = 86400
+logsyncinterval = 10
+historylimit = 1000
+
+# lines kept per nick while no client is connected, with all channels,
+# virtual users and inputs kept running (0 to close everything on disconnect),
+# and seconds after which such a detached session is given up (0 for never)
+sessionbuffer = 0
+sessiontimeout = 86400
+
+# detached sessions, by nick
+sessions = { }
+
+# directory to keep the state of inputs in, like the offsets of followed files
+# (None to disable)
+statedir = None
+
+# bytes every input reads at most per event loop iteration, before the others
+# and the irc connections get their turn
+readbudget = 16*1024
+
+# directory with additional inputs, one module per input, named like the
+# input type (None for only the builtin inputs)
+plugindir = None
+
+# records kept in memory for trace dumps (0 to disable tracing), the
+# categories recorded (in, out, channel, input, comma separated), and to only
+# record every tracesample-th event of each. Lines of channels and inputs are
+# as many as the inputs read, only enable them for a while, or sample them.
+tracesize = 10000
+tracecategories = 'in,out'
+tracesample = 1
+
+# local port to serve all metrics on as plain text over http (0 to disable),
+# and the address of a statsd server to send them to every statsdinterval
+# seconds (None to disable)
+metricsport = 0
+statsd = None
+statsdinterval = 10
+statsdprefix = 'irclogd'
+
 motd = """
 This is irclogd, started at {starttime}, listening on {port}.
 
@@ -46,20 +120,58 @@ class Channel:
         self.creationtime = time.time()
         self.topicmsg = None
 
+        self.scrollback = None
+        maxlines = getattr(server.factory, 'scrollbacklines', scrollbacklines)
+        if maxlines > 0:
+            self.scrollback = scrollback.store.get((server.nick, name), maxlines,
+                    getattr(server.factory, 'scrollbackbytes', scrollbackbytes))
+
+        self.log = None
+        if logstore.store is not None:
+            self.log = logstore.store.get(server.nick, name)
+
+        # repeats of recent lines are suppressed, if set
+        self.dedup = None
+
+        # statistics
+        self.lines = 0
+        self.bytes = 0
+
     # channel interfacing methods
 
     def msg(self, msg, prefix = None):
         self.server.sendMessage('PRIVMSG', irc.lowQuote(msg), frm=self.name, prefix=prefix if prefix is not None else self.server.hostname)
 
-    def notice(self, msg, prefix):
-        self.server.sendMessage('NOTICE', irc.lowQuote(msg), frm=self.name, prefix=prefix)
+    def notice(self, msg, prefix = None):
+        self.server.sendMessage('NOTICE', irc.lowQuote(msg), frm=self.name, prefix=prefix if prefix is not None else self.server.hostname)
+
+    def send(self, prefix, msg):
+        """
+            Sends an already quoted msg to this channel, after the serialized
+            PRIVMSG prefix. Only lines sent this way end up in the scrollback
+            and the log, and only they are deduplicated, by msg alone, no
+            matter which virtual user sent them.
+        """
+        if self.dedup is not None and self.dedup.seen(msg):
+            return
+        line = prefix + msg
+        if 'channel' in trace.tracer.enabled:
+            trace.tracer.record('channel', self.name, line)
+        self.lines += 1
+        self.bytes += len(line)
+        if self.scrollback is not None:
+            self.scrollback.append(line)
+        if self.log is not None:
+            self.log.append(line)
+        self.server.sendLine(line, self.name)
 
     # user management
 
     def registerUser(self, user):
         if user.name not in self.pusers:
             self.pusers[user.name] = user
-            self.server.sendMessage("JOIN", self.name, frm="", prefix=user.fullname())
+            if not user.quiet:
+                self.server.sendMessage("JOIN", self.name, frm="", prefix=user.fullname())
 
     def unregisterUser(self, user, kick=False):
         if user.name in self.pusers:
@@ -71,11 +183,15 @@ class Channel:
 
     # channel information callbacks
 
-    def join(self):
+    def join(self, replay = True):
         self.server.sendMessage("JOIN", frm=self.name, prefix=self.server.nick)
         self.topic()
         self.names()
 
+        # replay the scrollback in one go
+        if replay and self.scrollback is not None and len(self.scrollback.lines) > 0:
+            self.server.outq.write(self.scrollback.replay())
+
     def part(self):
         # As long as someone's here, tell them to leave.
         while len(self.pusers) > 0:
@@ -124,12 +240,175 @@ class Channel:
         # otherwise - is it a method?
         method = getattr(self, "cmd_%s" % line[0], None)
         if method is not None:
-            method(line[1])
+            method(line[1] if len(line) > 1 else "")
             return
 
     def cmd_help(self, params):
         self.notice("Halp!")
 
+    def cmd_stats(self, params):
+        self.notice("{}: {} lines, {} bytes out".format(self.name, self.lines, self.bytes))
+        if self.dedup is not None:
+            self.notice(self.dedup.stats())
+        for l in self.server.outq.stats():
+            self.notice(l)
+        latency = metrics.latency
+        if latency.count > 0:
+            self.notice("latency from input to write: p50 < {}s, p90 < {}s, p99 < {}s, {} writes".format(
+                    latency.quantile(0.5), latency.quantile(0.9), latency.quantile(0.99), latency.count))
+
+    def metrics(self, labels):
+        labels = dict(labels, channel=self.name)
+        yield "channel_lines_total", "counter", labels, self.lines
+        yield "channel_bytes_total", "counter", labels, self.bytes
+        if self.dedup is not None:
+            yield "channel_duplicates_total", "counter", labels, self.dedup.suppressed
+            yield "channel_dedup_entries", "gauge", labels, len(self.dedup.expiries)
+
+    def cmd_dedup(self, params):
+        """
+            Shows, sets or removes ("dedup off") the window in which repeats
+            of a line are suppressed, e.g. dedup 10s [entries 10000].
+        """
+        params = params.split()
+        if len(params) == 0:
+            if self.dedup is None:
+                self.notice("No dedup window. Usage: dedup duration [entries n], or dedup off")
+            else:
+                self.notice(self.dedup.stats())
+            return
+
+        if params[0] == "off":
+            self.dedup = None
+            self.notice("Dedup window removed.")
+            return
+
+        try:
+            self.dedup = DedupWindowFromParams(params)
+        except Exception as e:
+            self.notice("Failed setting dedup window: " + str(e))
+        else:
+            self.notice("Dedup window set to " + str(self.dedup))
+
+    def cmd_trace(self, params):
+        """
+            Shows the state of the tracer, switches categories on or off
+            (trace on|off [category ..]), sets the sampling (trace sample n)
+            or shows the last records (trace dump [n] [category ..]).
+        """
+        params = params.split()
+        tracer = trace.tracer
+        if len(params) == 0:
+            self.notice(tracer.stats())
+            return
+
+        try:
+            if params[0] == "on":
+                tracer.enable(params[1:] or trace.categories)
+            elif params[0] == "off":
+                tracer.disable(params[1:] or trace.categories)
+            elif params[0] == "sample" and len(params) == 2:
+                if int(params[1]) < 1:
+                    raise Exception("Sample must be at least 1")
+                tracer.sample = int(params[1])
+            elif params[0] == "dump":
+                n = 50
+                if len(params) > 1 and params[1].isdigit():
+                    n = min(int(params[1]), getattr(self.server.factory, 'historylimit', historylimit))
+                    params = params[1:]
+                for l in tracer.dump(n, params[1:] or None):
+                    self.notice(l)
+                self.notice("End of trace.")
+                return
+            else:
+                self.notice("Usage: trace [on|off [category ..]|sample n|dump [n] [category ..]]")
+                return
+        except Exception as e:
+            self.notice("Failed changing trace: " + str(e))
+        else:
+            self.notice(tracer.stats())
+
+    def cmd_history(self, params):
+        """
+            Shows the logged lines of the last given duration, e.g. 10m.
+        """
+        if self.log is None:
+            self.notice("There is no log for this channel, set logdir to enable it.")
+            return
+
+        try:
+            since = time.time() - logstore.parseDuration(params.strip() or "1h")
+        except Exception as e:
+            self.notice(str(e))
+            return
+
+        self.history(self.log.query(since, progress=1000))
+
+    def cmd_grep(self, params):
+        """
+            Shows the logged lines matching a regex, optionally only those of
+            the last given duration: grep <regex> [since <duration>]
+        """
+        if self.log is None:
+            self.notice("There is no log for this channel, set logdir to enable it.")
+            return
+
+        since = 0
+        words = params.rsplit(None, 2)
+        if len(words) == 3 and words[1] == "since":
+            params = words[0]
+            try:
+                since = time.time() - logstore.parseDuration(words[2])
+            except Exception as e:
+                self.notice(str(e))
+                return
+
+        try:
+            pattern = re.compile(params)
+        except re.error as e:
+            self.notice("Invalid regex: " + str(e))
+            return
+
+        self.history(self.log.query(since, pattern=pattern, progress=1000))
+
+    def history(self, results):
+        """
+            Streams log query results to the channel, a few lines per reactor
+            iteration. While the outgoing queue is more than half full, the
+            stream waits for it to drain. A None result means the query is
+            still scanning, and gives the reactor a turn.
+        """
+        limit = getattr(self.server.factory, 'historylimit', historylimit)
+        outq = self.server.outq
+
+        def stream():
+            n = 0
+            for r in results:
+                if r is None:
+                    yield None
+                    continue
+                if n == limit:
+                    break
+                t, line = r
+                while outq.paused or len(outq.bulk) > outq.maxlines / 2:
+                    yield task.deferLater(reactor, 0.1, lambda: None)
+                if not self.server.connected:
+                    return
+                i = line.find(" :", 1) + 2
+                self.server.sendLine(line[:i] + time.strftime("[%Y-%m-%d %H:%M:%S] ", time.localtime(t)) + line[i:], self.name)
+                n += 1
+                yield None
+
+            # notices take priority, so let the lines go out first
+            while outq.paused or len(outq.bulk) > 0:
+                yield task.deferLater(reactor, 0, lambda: None)
+            if n == limit:
+                self.notice("Stopped after {} lines.".format(limit))
+            else:
+                self.notice("End of history, {} lines.".format(n))
+
+        task.cooperate(stream())
+
 class IrclogdServer(irc.IRC):
     """
         This is one log server connection. It maintains a number of Channels
@@ -137,14 +416,140 @@ class IrclogdServer(irc.IRC):
     """
 
     def dataReceived(self, data):
-        if self.factory.debug:
-            print data
+        trace.tracer.record('in', getattr(self, 'nick', None), data)
         irc.IRC.dataReceived(self, data)
 
     def connectionMade(self):
         irc.IRC.connectionMade(self)
         self.channels = { }
         self.pusers = { }
+        self.outq = OutputQueue(self.transport,
+                getattr(self.factory, 'batchsize', batchsize),
+                getattr(self.factory, 'flushinterval', flushinterval),
+                getattr(self.factory, 'queuelines', queuelines),
+                getattr(self.factory, 'queuebytes', queuebytes),
+                getattr(self.factory, 'queuepolicy', queuepolicy))
+
+        scrollback.store.maxbytes = getattr(self.factory, 'scrollbackmemory', scrollbackmemory)
+        hub.budget = getattr(self.factory, 'readbudget', readbudget)
+
+        if logstore.store is None and getattr(self.factory, 'logdir', logdir) is not None:
+            logstore.store = logstore.LogStore(self.factory.logdir,
+                    getattr(self.factory, 'logsegmentsize', logsegmentsize),
+                    getattr(self.factory, 'logsegmentage', logsegmentage),
+                    syncinterval=getattr(self.factory, 'logsyncinterval', logsyncinterval))
+
+        self.dropcall = task.LoopingCall(self.reportDrops)
+        self.dropcall.start(getattr(self.factory, 'dropreport', dropreport), now=False)
+
+        metrics.register(self)
+
+    def connectionLost(self, reason):
+        self.dropcall.stop()
+        if self.detachable():
+            self.detach()
+        else:
+            metrics.unregister(self)
+            self.outq.stop()
+        irc.IRC.connectionLost(self, reason)
+
+    # detached sessions
+
+    def detachable(self):
+        return getattr(self.factory, 'sessionbuffer', sessionbuffer) > 0 and len(self.pusers) > 0 \
+                and getattr(self, 'nick', None) is not None and self.nick not in sessions
+
+    def detach(self):
+        """
+            Keeps the channels, virtual users and inputs of this connection
+            running after the client is gone, buffering up to sessionbuffer
+            lines, until a client with the same nick resumes the session.
+        """
+        self.outq.detach(getattr(self.factory, 'sessionbuffer', sessionbuffer))
+        self.detached = time.time()
+        sessions[self.nick] = self
+
+        self.expirecall = None
+        timeout = getattr(self.factory, 'sessiontimeout', sessiontimeout)
+        if timeout > 0:
+            self.expirecall = reactor.callLater(timeout, self.expire)
+
+    def expire(self):
+        """
+            Gives up a detached session, closing all its inputs.
+        """
+        self.expirecall = None
+        if sessions.get(self.nick) is self:
+            del sessions[self.nick]
+        metrics.unregister(self)
+        while len(self.pusers) > 0:
+            self.pusers.values()[0].destroy()
+        self.outq.stop()
+
+    def resume(self, old):
+        """
+            Takes over a detached session: its channels, virtual users and
+            inputs, and the lines buffered while no client was connected,
+            which are sent in one batch after the channels are joined.
+        """
+        if old.expirecall is not None:
+            old.expirecall.cancel()
+        metrics.unregister(old)
+
+        for name, c in self.channels.iteritems():
+            old.channels.setdefault(name, c)
+        self.channels = old.channels
+        self.pusers = old.pusers
+
+        for c in self.channels.itervalues():
+            c.server = self
+        for u in self.pusers.itervalues():
+            u.server = self
+            u.invalidate()
+            if getattr(u, 'input', None) is not None:
+                self.outq.addInput(u.input)
+
+        for c in self.channels.itervalues():
+            c.join(replay=False)
+        self.sendMessage("NOTICE", "Resumed the session detached at {}, {} lines were buffered".format(
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(old.detached)), len(old.outq.bulk)))
+        self.outq.adopt(old.outq)
+        old.outq.stop()
+
+    def metrics(self):
+        """
+            Yields the metrics of this connection, its channels and its
+            virtual users.
+        """
+        labels = { 'connection' : getattr(self, 'nick', None) }
+        for m in self.outq.metrics(labels):
+            yield m
+        for c in self.channels.values():
+            for m in c.metrics(labels):
+                yield m
+        for u in self.pusers.values():
+            if hasattr(u, 'metrics'):
+                for m in u.metrics(labels):
+                    yield m
+
+    def reportDrops(self):
+        """
+            Tells every channel how many of its lines were dropped from the
+            outgoing queue since the last report.
+        """
+        for target, n in self.outq.takeDrops().iteritems():
+            if target in self.channels:
+                self.channels[target].notice("{} lines dropped, the client is not keeping up".format(n))
+
+    def sendLine(self, line, target = None):
+        """
+            All lines go through the output queue, which coalesces them into
+            one write per reactor iteration. Lines with a target are bulk
+            messages, which may be dropped if the client is too slow.
+        """
+        if isinstance(line, unicode):
+            line = line.encode(getattr(self, "encoding", None) or "utf-8")
+        self.outq.write(line + irc.CR + irc.LF, target)
 
     def sendMessage(self, command, *parameter_list, **kwargs):
         """
@@ -155,6 +560,8 @@ class IrclogdServer(irc.IRC):
                 - If no frm kwarg is given, the user's nick will be inserted as
                   first argument.
                 - The last argument is prefixed with a colon.
+            PRIVMSGs are queued as bulk messages, everything else is control
+            traffic which takes priority.
         """
 
         # add nick to param list
@@ -166,18 +573,16 @@ class IrclogdServer(irc.IRC):
         if 'prefix' not in kwargs:
             kwargs['prefix'] = self.hostname
 
+        # unicode names and byte lines don't mix, send everything as bytes
+        parameter_list = [ user.utf8(p) for p in parameter_list ]
+
         # prefix last param with a :
         if len(parameter_list) > 0:
             parameter_list[-1] = ":" + parameter_list[-1]
 
-        if self.factory.debug:
-            if command in irc.numeric_to_symbolic:
-                print kwargs['prefix'], '{}[{}]'.format(command, irc.numeric_to_symbolic[command]), ' '.join(parameter_list)
-            else:
-                print kwargs['prefix'], command, ' '.join(parameter_list)
-
-        # forwad to parent method
-        return irc.IRC.sendMessage(self, command, *parameter_list, **kwargs)
+        line = ":%s %s" % (user.utf8(kwargs['prefix']), ' '.join([command] + parameter_list))
+        trace.tracer.record('out', self.nick, command, line)
+        self.sendLine(line, parameter_list[0] if command == 'PRIVMSG' else None)
 
     # Channel management callbacks
 
@@ -340,6 +745,60 @@ class IrclogdServer(irc.IRC):
         self.sendMessage(irc.RPL_ENDOFMOTD, "End of /MOTD command")
         self.sendMessage(irc.RPL_MYINFO, "irclogd", "0.1", "i", "")
 
+        if getattr(self, 'nick', None) in sessions:
+            self.resume(sessions.pop(self.nick))
+        elif getattr(self.factory, 'config', None) is not None:
+            self.provision(self.factory.config)
+
+    def provision(self, cfg):
+        """
+            Builds all channels and virtual users of a Config in one pass.
+            Users join their channels quietly and inputs are set up without
+            notices, so the client only gets one JOIN, topic and NAMES per
+            channel, and a notice for everything that failed.
+        """
+        errors = [ ]
+
+        for name, options in cfg.channels:
+            if name not in self.channels:
+                c = Channel(self, name)
+                c.topicmsg = options.get('topic')
+                if 'dedup' in options:
+                    try:
+                        c.dedup = DedupWindowFromParams(options['dedup'].split())
+                    except Exception as e:
+                        errors.append("channel {}: {}".format(name, e))
+                self.channels[name] = c
+
+        for name, options in cfg.users:
+            if name in self.pusers:
+                continue
+            u = user.InputUser(self, name)
+            self.pusers[u.name] = u
+
+            u.quiet = True
+            for chan in options['channels']:
+                u.invite(self.channels[chan])
+            try:
+                for rule in options.get('routes', '').splitlines():
+                    if rule.strip():
+                        u.addRoute(rule)
+                if 'format' in options:
+                    u.setFormat(options['format'].split())
+                if 'ratelimit' in options:
+                    u.setRateLimit(options['ratelimit'].split())
+                if 'input' in options:
+                    u.setInput(options['input'].split())
+            except Exception as e:
+                errors.append("user {}: {}".format(name, e))
+            u.quiet = False
+
+        for name, options in cfg.channels:
+            self.channels[name].join()
+
+        for e in errors:
+            self.sendMessage("NOTICE", "Config error for " + e)
+
     def irc_NICK(self, prefix, params):
         self.nick = params[0]
 
@@ -351,8 +810,13 @@ class IrclogdServer(irc.IRC):
             reactor.
         """
         self.sendMessage("QUIT", *params, prefix=self.nick)
+        self.outq.flush()
         self.transport.loseConnection()
 
+        # with sessions, everything is kept for the next client
+        if self.detachable():
+            return
+
         while len(self.pusers) > 0:
             # we're relying on this call to work properly.. maybe add infinite loop protection?
             self.pusers.values()[0].destroy()
@@ -361,9 +825,51 @@ class IrclogdServer(irc.IRC):
         print >> sys.stderr, "unkown msg", prefix, command, params
 
 if __name__ == "__main__":
+    # an optional config file may be given as only argument
+    cfg = config.Config(sys.argv[1]) if len(sys.argv) > 1 else None
+    if cfg is not None:
+        port = cfg.get('port', port)
+        debug = cfg.get('debug', debug)
+
     factory = protocol.Factory()
     factory.debug = debug
+    factory.tracesize = tracesize
+    factory.tracecategories = tracecategories
+    factory.tracesample = tracesample
+    factory.batchsize = batchsize
+    factory.flushinterval = flushinterval
+    factory.queuelines = queuelines
+    factory.queuebytes = queuebytes
+    factory.queuepolicy = queuepolicy
+    factory.dropreport = dropreport
+    factory.scrollbacklines = scrollbacklines
+    factory.scrollbackbytes = scrollbackbytes
+    factory.scrollbackmemory = scrollbackmemory
+    factory.logdir = logdir
+    factory.logsegmentsize = logsegmentsize
+    factory.logsegmentage = logsegmentage
+    factory.logsyncinterval = logsyncinterval
+    factory.historylimit = historylimit
+    factory.statedir = statedir
+    factory.readbudget = readbudget
+    factory.plugindir = plugindir
+    factory.sessionbuffer = sessionbuffer
+    factory.sessiontimeout = sessiontimeout
+    factory.metricsport = metricsport
+    factory.statsd = statsd
+    factory.statsdinterval = statsdinterval
+    factory.statsdprefix = statsdprefix
     factory.protocol = IrclogdServer
 
+    factory.config = cfg
+    if cfg is not None:
+        cfg.apply(factory, sys.modules[__name__])
+
+    trace.install(factory.tracesize, factory.tracecategories, factory.tracesample, factory.debug)
+
     reactor.listenTCP(port, factory, interface='localhost')
+    if factory.metricsport:
+        reactor.listenTCP(factory.metricsport, metrics.MetricsSite(), interface='localhost')
+    if factory.statsd is not None:
+        metrics.StatsdReporter(factory.statsd, factory.statsdinterval, factory.statsdprefix)
     reactor.run()
@@ -0,0 +1,310 @@
+import os
+import re
+import mmap
+import time
+import struct
+import bisect
+
+from twisted.internet import reactor, task, threads
+from twisted.python import log
+
+# index entries: timestamp, byte offset of the first record at or after it
+indexentry = struct.Struct("!dQ")
+
+class Segment:
+    """
+        One segment file of a channel log. Records are lines of the form
+        "timestamp serialized-irc-line\\n". Every indexinterval bytes, an
+        entry pointing at the record's offset is added to the index file, so
+        a point in time can be found by bisecting the index and seeking.
+    """
+
+    def __init__(self, path, start):
+        self.path = path
+        self.start = start
+
+        self.fd = None
+        self.size = 0
+        self.indexed = None
+        self.index = None
+        # the Deferred of a running fsync
+        self.syncing = None
+
+    def logname(self):
+        return os.path.join(self.path, "{:.3f}.log".format(self.start))
+
+    def indexname(self):
+        return os.path.join(self.path, "{:.3f}.idx".format(self.start))
+
+    def open(self):
+        self.fd = os.open(self.logname(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        self.indexfd = os.open(self.indexname(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        self.size = os.fstat(self.fd).st_size
+        self.index = None
+
+    def write(self, records, entries):
+        os.write(self.fd, records)
+        if entries:
+            os.write(self.indexfd, entries)
+
+    def sync(self):
+        """
+            Returns a Deferred firing once the segment reached the disk. The
+            fsync runs in a thread, so it never blocks the reactor. While one
+            is running, no other is started.
+        """
+        if self.syncing is None:
+            fds = (self.fd, self.indexfd)
+            self.syncing = threads.deferToThread(lambda: [ os.fsync(fd) for fd in fds ])
+            self.syncing.addErrback(log.err, "Failed syncing " + self.logname())
+            self.syncing.addBoth(self.synced)
+        return self.syncing
+
+    def synced(self, ignored):
+        self.syncing = None
+
+    def close(self):
+        """
+            Syncs and closes the segment, in a thread, once a running fsync
+            is done with the files.
+        """
+        fds = (self.fd, self.indexfd)
+        self.fd = self.indexfd = None
+        name = self.logname()
+        def sync():
+            for fd in fds:
+                os.fsync(fd)
+                os.close(fd)
+        def close(ignored):
+            d = threads.deferToThread(sync)
+            d.addErrback(log.err, "Failed closing " + name)
+            return d
+        if self.syncing is not None:
+            return self.syncing.addBoth(close)
+        return close(None)
+
+    def loadIndex(self):
+        """
+            Returns the sparse index as a list of (timestamp, offset).
+        """
+        if self.index is not None:
+            return self.index
+        index = [ ]
+        try:
+            data = open(self.indexname(), 'rb').read()
+        except IOError:
+            data = ''
+        for i in xrange(0, len(data) - indexentry.size + 1, indexentry.size):
+            index.append(indexentry.unpack_from(data, i))
+        # the active segment keeps growing, only cache closed ones
+        if self.fd is None:
+            self.index = index
+        return index
+
+    def read(self, since, until):
+        """
+            Yields (timestamp, line) for all records in [since, until).
+        """
+        try:
+            f = open(self.logname(), 'rb')
+        except IOError:
+            return
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return
+            data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        try:
+            # seek to the last index entry before since
+            index = self.loadIndex()
+            i = bisect.bisect_left(index, (since, 0)) - 1
+            pos = index[i][1] if i >= 0 else 0
+
+            find = data.find
+            while pos < size:
+                end = find("\n", pos)
+                if end < 0:
+                    break
+                sep = find(" ", pos, end)
+                t = float(data[pos:sep])
+                if t >= until:
+                    break
+                if t >= since:
+                    yield t, data[sep+1:end]
+                pos = end + 1
+        finally:
+            data.close()
+
+class ChannelLog:
+    """
+        The append-only log of a channel. Appended lines are buffered in
+        memory and written by LogStore.flush, segments are rotated when they
+        exceed segmentsize bytes or segmentage seconds.
+    """
+
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.segments = [ ]
+        for name in sorted(os.listdir(path)):
+            if name.endswith(".log"):
+                try:
+                    self.segments.append(Segment(path, float(name[:-4])))
+                except ValueError:
+                    continue
+        self.segments.sort(key=lambda s: s.start)
+
+        self.pending = [ ]
+        self.pendingentries = [ ]
+        self.pendingsize = 0
+
+    def current(self, now):
+        """
+            Returns the segment to write to, rotating if necessary.
+        """
+        seg = self.segments[-1] if self.segments else None
+        if seg is not None and seg.fd is None and now - seg.start < self.store.segmentage:
+            # left over from before a restart, keep appending to it
+            seg.open()
+        if seg is None or seg.fd is None or seg.size + self.pendingsize >= self.store.segmentsize or now - seg.start >= self.store.segmentage:
+            start = now
+            if seg is not None:
+                if seg.fd is not None:
+                    self.flush()
+                    seg.close()
+                # segments are named by their start, which must be unique
+                start = max(now, seg.start + 0.001)
+            seg = Segment(self.path, start)
+            seg.open()
+            self.segments.append(seg)
+        return seg
+
+    def append(self, line):
+        now = time.time()
+        seg = self.current(now)
+
+        record = "{:.3f} {}\n".format(now, line)
+        offset = seg.size + self.pendingsize
+        if seg.indexed is None or offset - seg.indexed >= self.store.indexinterval:
+            self.pendingentries.append(indexentry.pack(now, offset))
+            seg.indexed = offset
+
+        self.pending.append(record)
+        self.pendingsize += len(record)
+
+    def flush(self):
+        if not self.pending:
+            return
+        seg = self.segments[-1]
+        seg.write(''.join(self.pending), ''.join(self.pendingentries))
+        seg.size += self.pendingsize
+        self.pending = [ ]
+        self.pendingentries = [ ]
+        self.pendingsize = 0
+
+    def sync(self):
+        if self.segments and self.segments[-1].fd is not None:
+            return self.segments[-1].sync()
+
+    def close(self):
+        self.flush()
+        if self.segments and self.segments[-1].fd is not None:
+            self.segments[-1].close()
+
+    def query(self, since, until = None, pattern = None, progress = None):
+        """
+            Yields (timestamp, line) for all records in [since, until) whose
+            text matches the pattern, if one is given. With progress, None is
+            yielded in between every progress records scanned, so a consumer
+            can give others a turn while few records match.
+        """
+        n = 0
+        if until is None:
+            until = time.time() + 1
+        # make sure the latest lines are in the files
+        self.flush()
+
+        for i, seg in enumerate(self.segments):
+            # skip segments which end before since, or start after until
+            if i + 1 < len(self.segments) and self.segments[i+1].start <= since:
+                continue
+            if seg.start >= until:
+                break
+            for t, line in seg.read(since, until):
+                if pattern is None or pattern.search(line, line.find(" :", 1) + 2):
+                    yield t, line
+                n += 1
+                if n == progress:
+                    n = 0
+                    yield None
+
+class LogStore:
+    """
+        The on-disk history of all channels, in one directory per nick and
+        channel. Writes are buffered and flushed every flushinterval seconds,
+        and synced to disk every syncinterval seconds, outside the reactor
+        thread.
+    """
+
+    def __init__(self, directory, segmentsize = 16*1024*1024, segmentage = 86400,
+            indexinterval = 64*1024, flushinterval = 1, syncinterval = 10):
+        self.directory = directory
+        self.segmentsize = segmentsize
+        self.segmentage = segmentage
+        self.indexinterval = indexinterval
+
+        self.logs = { }
+
+        self.flushcall = task.LoopingCall(self.flush)
+        self.flushcall.start(flushinterval, now=False)
+        self.synccall = task.LoopingCall(self.sync)
+        self.synccall.start(syncinterval, now=False)
+
+        reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def get(self, nick, channel):
+        key = (nick, channel)
+        if key not in self.logs:
+            self.logs[key] = ChannelLog(self, os.path.join(self.directory, quote(nick), quote(channel)))
+        return self.logs[key]
+
+    def flush(self):
+        for log in self.logs.itervalues():
+            log.flush()
+
+    def sync(self):
+        for log in self.logs.itervalues():
+            log.sync()
+
+    def close(self):
+        self.flushcall.stop()
+        self.synccall.stop()
+        for log in self.logs.itervalues():
+            log.close()
+
+def quote(name):
+    """
+        Makes a nick or channel name safe to use as directory name.
+    """
+    return re.sub(r'[^\w&#.-]', lambda m: "%{:02x}".format(ord(m.group())), name)
+
+def parseDuration(s):
+    """
+        Parses durations like 30s, 10m, 2h or 1d into seconds.
+    """
+    units = { 's' : 1, 'm' : 60, 'h' : 3600, 'd' : 86400, 'w' : 604800 }
+    try:
+        if s[-1] in units:
+            return float(s[:-1]) * units[s[-1]]
+        return float(s)
+    except (IndexError, ValueError):
+        raise Exception("Invalid duration: " + s)
+
+# the process wide store, if enabled
+store = None
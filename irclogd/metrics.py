@@ -0,0 +1,170 @@
+import socket
+import bisect
+import itertools
+
+from twisted.internet import task
+from twisted.python import log
+from twisted.web import server, resource
+
+class Histogram:
+    """
+        A histogram with fixed bucket bounds. Observing a value costs one
+        bisect and two additions.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [ 0 ] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+            Returns the upper bound of the bucket containing the q-quantile.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if n >= rank:
+                return self.bounds[i] if i < len(self.bounds) else float('inf')
+        return float('inf')
+
+# seconds from reading a line from an input until it is written to the client,
+# observed once per write for the oldest line in it
+latency = Histogram([ 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10 ])
+
+# while an input processes a read, the time it happened
+received = None
+
+# everything with a metrics() method yielding (name, type, labels, value)
+collectors = set()
+
+def register(collector):
+    collectors.add(collector)
+
+def unregister(collector):
+    collectors.discard(collector)
+
+def collect():
+    """
+        Yields (name, type, labels, value) for all metrics but the latency
+        histogram.
+    """
+    for c in list(collectors):
+        # one failing collector must not take the others with it
+        try:
+            for m in c.metrics():
+                yield m
+        except Exception:
+            log.err(None, "Failed collecting metrics")
+
+def labelvalue(v):
+    """
+        Returns a label value as a byte string, channel and user names are
+        unicode.
+    """
+    return v.encode('utf-8') if isinstance(v, unicode) else str(v)
+
+def labelstring(labels):
+    if not labels:
+        return ""
+    return "{" + ','.join('{}="{}"'.format(k, labelvalue(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in sorted(labels.iteritems())) + "}"
+
+def render():
+    """
+        Renders all metrics in the plaintext exposition format understood by
+        Prometheus and friends.
+    """
+    result = [ ]
+    types = { }
+    for name, type, labels, value in collect():
+        if name not in types:
+            types[name] = type
+            result.append("# TYPE irclogd_{} {}".format(name, type))
+        result.append("irclogd_{}{} {}".format(name, labelstring(labels), value))
+
+    result.append("# TYPE irclogd_latency_seconds histogram")
+    n = 0
+    for bound, count in zip(latency.bounds + [ "+Inf" ], latency.counts):
+        n += count
+        result.append('irclogd_latency_seconds_bucket{{le="{}"}} {}'.format(bound, n))
+    result.append("irclogd_latency_seconds_sum {}".format(latency.sum))
+    result.append("irclogd_latency_seconds_count {}".format(latency.count))
+    return '\n'.join(result) + '\n'
+
+class MetricsResource(resource.Resource):
+    """
+        Serves all metrics as plain text, on any path.
+    """
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/plain; version=0.0.4")
+        return render()
+
+def MetricsSite():
+    return server.Site(MetricsResource())
+
+class StatsdReporter:
+    """
+        Sends all metrics to a statsd server every interval seconds. Counters
+        are sent as the difference to the last report, gauges as they are.
+        Of the latency histogram, a few quantiles are sent as gauges.
+    """
+
+    def __init__(self, address, interval = 10, prefix = "irclogd"):
+        host, port = address.rsplit(':', 1)
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.last = { }
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+        self.call = task.LoopingCall(self.report)
+        self.call.start(interval, now=False)
+
+    def report(self):
+        lines = [ ]
+        current = { }
+        quantiles = [ ("latency_seconds", "gauge", { 'quantile' : 'p' + str(q) }, latency.quantile(q / 100.0)) for q in (50, 90, 99) ]
+        for name, type, labels, value in itertools.chain(collect(), quantiles):
+            # a bad sample is left out, and must not stop the looping call
+            try:
+                key = '.'.join([ self.prefix, name ] + [ labelvalue(v).replace('.', '_').replace(':', '_') for k, v in sorted(labels.iteritems()) ])
+                if type == "counter":
+                    current[key] = value
+                    lines.append("{}:{}|c".format(key, value - self.last.get(key, 0)))
+                else:
+                    lines.append("{}:{}|g".format(key, value))
+            except:
+                log.err(None, "Failed reporting metric " + name)
+        self.last = current
+
+        # stay below common mtu sizes
+        packet = [ ]
+        for l in lines:
+            if sum(len(p) + 1 for p in packet) + len(l) > 1400:
+                self.send('\n'.join(packet))
+                packet = [ ]
+            packet.append(l)
+        if packet:
+            self.send('\n'.join(packet))
+
+    def send(self, data):
+        try:
+            self.socket.sendto(data, self.address)
+        except socket.error:
+            pass
+
+    def stop(self):
+        self.call.stop()
+        self.socket.close()
@@ -0,0 +1,307 @@
+import time
+from collections import deque
+
+from zope.interface import implements
+
+from twisted.internet import reactor, interfaces
+
+import metrics
+
+class OutputQueue:
+    """
+        The output stage of a connection. Lines written to it are collected
+        and written to the transport with a single writeSequence call, at the
+        latest after interval seconds. An interval of 0 flushes once per
+        reactor iteration. If maxbatch lines are pending, they are flushed
+        right away.
+
+        There are two lanes: control traffic goes on the priority lane, which
+        is always written first. Bulk messages carry the name of their target
+        and go on the bulk lane, which is bounded by maxlines and maxbytes.
+
+        The queue registers as a push producer with the transport. While the
+        transport is paused, nothing is written and the bulk lane fills up.
+        Once it is full, the overflow policy decides what happens:
+            drop-oldest: the oldest bulk lines are dropped
+            drop-newest: the new line is dropped
+            pause:       all registered inputs are paused, and resumed once
+                         the lane drained to half its size. Lines are only
+                         dropped if the lane grows to twice its size anyway.
+
+        Batch sizes are counted in a histogram with power of two buckets, so
+        bucket i counts batches of 2**i up to 2**(i+1)-1 lines. Bulk lines
+        remember when their input read them, and every write records the
+        latency of its oldest one in metrics.latency.
+    """
+    implements(interfaces.IPushProducer)
+
+    buckets = 12
+    policies = ('drop-oldest', 'drop-newest', 'pause')
+
+    def __init__(self, transport, maxbatch = 1024, interval = 0,
+            maxlines = 10000, maxbytes = 4*1024*1024, policy = 'drop-oldest'):
+        if policy not in OutputQueue.policies:
+            raise Exception("Unknown queue policy: " + str(policy))
+
+        self.transport = transport
+        self.maxbatch = maxbatch
+        self.interval = interval
+        self.maxlines = maxlines
+        self.maxbytes = maxbytes
+        self.policy = policy
+
+        self.priority = [ ]
+        self.bulk = deque()
+        self.bulkbytes = 0
+        self.flushcall = None
+
+        # paused by the transport?
+        self.paused = False
+        # lost the transport, and only keeps bulk lines?
+        self.detached = False
+
+        # inputs which can be paused, and whether they are
+        self.inputs = [ ]
+        self.inputsPaused = False
+
+        # dropped lines per target, since they were last reported
+        self.drops = { }
+
+        # statistics
+        self.lines = 0
+        self.batches = 0
+        self.largest = 0
+        self.dropped = 0
+        self.histogram = [ 0 ] * OutputQueue.buckets
+
+        transport.registerProducer(self, True)
+
+    def write(self, line, target = None):
+        """
+            Queues a line, which must already include its delimiter. Lines
+            with a target go on the bulk lane, all others on the priority
+            lane.
+        """
+        if target is None:
+            if self.detached:
+                return
+            self.priority.append(line)
+        else:
+            if len(self.bulk) >= self.maxlines or self.bulkbytes + len(line) > self.maxbytes:
+                if not self.overflow(line, target):
+                    return
+            self.bulk.append((target, line, metrics.received))
+            self.bulkbytes += len(line)
+
+        if self.paused:
+            return
+
+        if len(self.priority) + len(self.bulk) >= self.maxbatch:
+            self.flush()
+        elif self.flushcall is None:
+            self.flushcall = reactor.callLater(self.interval, self.flush)
+
+    def overflow(self, line, target):
+        """
+            Applies the overflow policy for a line which does not fit into the
+            bulk lane anymore. Returns whether the line should be queued.
+        """
+        if self.policy == 'drop-oldest':
+            while len(self.bulk) > 0 and (len(self.bulk) >= self.maxlines or self.bulkbytes + len(line) > self.maxbytes):
+                old, l, received = self.bulk.popleft()
+                self.bulkbytes -= len(l)
+                self.drop(old)
+            return True
+
+        if self.policy == 'pause':
+            self.pauseInputs()
+            # lines which were already read are still accepted, up to a point
+            if len(self.bulk) < 2*self.maxlines and self.bulkbytes + len(line) <= 2*self.maxbytes:
+                return True
+
+        self.drop(target)
+        return False
+
+    def drop(self, target):
+        self.dropped += 1
+        self.drops[target] = self.drops.get(target, 0) + 1
+
+    def takeDrops(self):
+        """
+            Returns the dropped lines per target since the last call.
+        """
+        drops = self.drops
+        self.drops = { }
+        return drops
+
+    def flush(self):
+        """
+            Writes all pending priority lines, followed by up to maxbatch bulk
+            lines. If bulk lines are left over, another flush is scheduled.
+        """
+        if self.flushcall is not None:
+            if self.flushcall.active():
+                self.flushcall.cancel()
+            self.flushcall = None
+
+        if self.paused:
+            return
+
+        pending = self.priority
+        self.priority = [ ]
+
+        n = min(len(self.bulk), max(self.maxbatch - len(pending), 0))
+        oldest = self.bulk[0][2] if n > 0 else None
+        popleft = self.bulk.popleft
+        for i in xrange(n):
+            pending.append(popleft()[1])
+            self.bulkbytes -= len(pending[-1])
+
+        if self.inputsPaused and len(self.bulk) <= self.maxlines / 2 and self.bulkbytes <= self.maxbytes / 2:
+            self.resumeInputs()
+
+        if not pending:
+            return
+
+        # more work left? continue in the next iteration
+        if len(self.bulk) > 0:
+            self.flushcall = reactor.callLater(0, self.flush)
+
+        self.transport.writeSequence(pending)
+
+        n = len(pending)
+        self.lines += n
+        self.batches += 1
+        if n > self.largest:
+            self.largest = n
+        self.histogram[min(n.bit_length(), OutputQueue.buckets) - 1] += 1
+        if oldest is not None:
+            metrics.latency.observe(time.time() - oldest)
+
+    # input management
+
+    def addInput(self, input):
+        """
+            Registers an input, which is paused by the pause policy. Inputs
+            must provide pauseProducing and resumeProducing methods.
+        """
+        self.inputs.append(input)
+        if self.inputsPaused:
+            input.pauseProducing()
+
+    def removeInput(self, input):
+        if input in self.inputs:
+            self.inputs.remove(input)
+
+    def pauseInputs(self):
+        if self.inputsPaused:
+            return
+        self.inputsPaused = True
+        for i in self.inputs:
+            i.pauseProducing()
+
+    def resumeInputs(self):
+        if not self.inputsPaused:
+            return
+        self.inputsPaused = False
+        for i in self.inputs:
+            i.resumeProducing()
+
+    # IPushProducer, called by the transport
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.flush()
+
+    def stopProducing(self):
+        # the connection decides whether to stop() or detach() the queue
+        if self.flushcall is not None and self.flushcall.active():
+            self.flushcall.cancel()
+        self.flushcall = None
+        self.paused = True
+
+    def stop(self):
+        """
+            Drops all pending lines and cancels the scheduled flush.
+        """
+        if self.flushcall is not None and self.flushcall.active():
+            self.flushcall.cancel()
+        self.flushcall = None
+        self.priority = [ ]
+        self.bulk.clear()
+        self.bulkbytes = 0
+        # don't leave anyone hanging
+        self.resumeInputs()
+        self.inputs = [ ]
+
+    def buffered(self):
+        """
+            Returns the number of bytes written to the transport, but not yet
+            sent.
+        """
+        t = self.transport
+        return len(getattr(t, 'dataBuffer', '')) - getattr(t, 'offset', 0) + getattr(t, '_tempDataLen', 0)
+
+    def metrics(self, labels):
+        yield "output_lines_total", "counter", labels, self.lines
+        yield "output_writes_total", "counter", labels, self.batches
+        yield "output_dropped_lines_total", "counter", labels, self.dropped
+        yield "output_queued_lines", "gauge", labels, len(self.priority) + len(self.bulk)
+        yield "output_queued_bytes", "gauge", labels, self.bulkbytes
+        yield "output_buffered_bytes", "gauge", labels, self.buffered()
+        yield "output_paused", "gauge", labels, int(self.paused)
+
+    def detach(self, maxlines):
+        """
+            Keeps the queue around after the transport is gone, holding the
+            last maxlines bulk lines until another queue adopts them. Inputs
+            keep running, control traffic is discarded.
+        """
+        if self.flushcall is not None and self.flushcall.active():
+            self.flushcall.cancel()
+        self.flushcall = None
+        self.detached = True
+        self.paused = True
+        self.priority = [ ]
+        self.maxlines = maxlines
+        self.policy = 'drop-oldest'
+        self.resumeInputs()
+        self.inputs = [ ]
+        while len(self.bulk) > maxlines:
+            target, line, received = self.bulk.popleft()
+            self.bulkbytes -= len(line)
+            self.drop(target)
+
+    def adopt(self, other):
+        """
+            Takes over the bulk lines and drop counts of a detached queue.
+            The lines go to the front of the bulk lane, after the pending
+            priority lines and before any newer bulk line, and are written
+            like any other, so a paused transport holds them back.
+        """
+        self.dropped += other.dropped
+        for target, n in other.takeDrops().iteritems():
+            self.drops[target] = self.drops.get(target, 0) + n
+
+        self.bulk.extendleft(reversed(other.bulk))
+        self.bulkbytes += other.bulkbytes
+        other.bulk.clear()
+        other.bulkbytes = 0
+        self.flush()
+
+    def stats(self):
+        """
+            Returns a list of human readable statistic lines.
+        """
+        result = [ "output: {} lines in {} writes, {:.1f} lines per write, largest {}".format(
+                self.lines, self.batches, float(self.lines) / self.batches if self.batches else 0.0, self.largest) ]
+        result.append("output batch sizes: " + ' '.join(
+                "{}+:{}".format(2**i, n) for i, n in enumerate(self.histogram) if n > 0))
+        result.append("output queue: {} priority, {} bulk lines ({} bytes), {} dropped, policy {}{}{}".format(
+                len(self.priority), len(self.bulk), self.bulkbytes, self.dropped, self.policy,
+                ", transport paused" if self.paused else "", ", inputs paused" if self.inputsPaused else ""))
+        result.append("output buffer: {} bytes written but not yet sent".format(self.buffered()))
+        return result
@@ -0,0 +1,180 @@
+import re
+import sre_parse
+
+class Rule:
+    """
+        A routing rule: lines matching pattern go to the channels in targets,
+        or are dropped if targets is None. Raises re.error if the pattern is
+        invalid.
+
+        Patterns with backreferences, named groups or inline flags change
+        their meaning inside a combined pattern, such rules are matched on
+        their own.
+    """
+
+    def __init__(self, pattern, targets):
+        self.pattern = pattern
+        self.targets = targets
+        self.regex = re.compile(pattern)
+        parsed = sre_parse.parse(pattern)
+        self.alone = bool(parsed.pattern.flags or parsed.pattern.groupdict or references(parsed))
+        self.hits = 0
+
+    def __str__(self):
+        if self.targets is None:
+            return "drop /{}/".format(self.pattern)
+        return "/{}/ {}".format(self.pattern, ','.join(self.targets))
+
+class Router:
+    """
+        Routes lines to channels by regular expressions.
+
+        All drop rules are compiled into one combined pattern, and so are all
+        route rules, so a line is scanned at most twice, no matter how many
+        rules there are. Drop rules are checked first. Among the route rules,
+        the match starting first in the line wins, and of several rules
+        matching at the same position, the one added first.
+
+        Lines matching no rule go to the default targets, or to all channels
+        if there are none. Rules which can't be combined are searched one by
+        one after the combined patterns, with the same precedence.
+    """
+
+    def __init__(self):
+        self.rules = [ ]
+        self.default = None
+        self.unmatched = 0
+
+        self.drops = None
+        self.routes = None
+        # (index, rule) of the rules matched on their own
+        self.alone = [ ]
+
+    def add(self, pattern, targets):
+        """
+            Adds a rule, targets None makes it a drop rule. Raises an
+            Exception if the pattern is invalid, leaving the rules as they
+            were.
+        """
+        try:
+            rule = Rule(pattern, targets)
+        except re.error as e:
+            raise Exception("Invalid regex: " + str(e))
+        self.compile(self.rules + [ rule ])
+
+    def remove(self, index):
+        rules = list(self.rules)
+        del rules[index]
+        self.compile(rules)
+
+    def compile(self, rules):
+        """
+            Builds the combined patterns of rules, and only then makes them
+            the current rules. Each rule becomes a named group, so the
+            matching rule can be told from lastgroup.
+        """
+        def combine(drop):
+            parts = [ "(?P<r{}>{})".format(i, r.pattern) for i, r in enumerate(rules) if (r.targets is None) == drop and not r.alone ]
+            return re.compile('|'.join(parts)) if parts else None
+
+        try:
+            drops = combine(True)
+            routes = combine(False)
+        except (re.error, AssertionError) as e:
+            # python 2 asserts there are at most 100 groups
+            raise Exception("Can't combine rules: " + str(e))
+
+        self.rules = rules
+        self.drops = drops
+        self.routes = routes
+        self.alone = [ (i, r) for i, r in enumerate(rules) if r.alone ]
+
+    def route(self, line):
+        """
+            Returns the target channel names for a line, an empty tuple if it
+            is dropped, or None if it goes to the default.
+        """
+        if self.drops is not None:
+            m = self.drops.search(line)
+            if m is not None:
+                self.rules[int(m.lastgroup[1:])].hits += 1
+                return ()
+        for i, rule in self.alone:
+            if rule.targets is None and rule.regex.search(line) is not None:
+                rule.hits += 1
+                return ()
+
+        best = None
+        if self.routes is not None:
+            m = self.routes.search(line)
+            if m is not None:
+                best, start = int(m.lastgroup[1:]), m.start()
+        for i, rule in self.alone:
+            if rule.targets is not None:
+                m = rule.regex.search(line)
+                if m is not None and (best is None or (m.start(), i) < (start, best)):
+                    best, start = i, m.start()
+
+        if best is not None:
+            rule = self.rules[best]
+            rule.hits += 1
+            return rule.targets
+
+        self.unmatched += 1
+        return self.default
+
+def references(parsed):
+    """
+        Returns whether a parsed pattern refers to one of its groups.
+    """
+    for op, av in parsed:
+        if op in (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS):
+            return True
+        if any(references(a) for a in subpatterns(av)):
+            return True
+    return False
+
+def subpatterns(av):
+    if isinstance(av, sre_parse.SubPattern):
+        yield av
+    elif isinstance(av, (tuple, list)):
+        for a in av:
+            for s in subpatterns(a):
+                yield s
+
+def parseRule(line):
+    """
+        Parses a rule of the form "/regex/ &chan[,#chan..]", "* &chan[,..]"
+        or "drop /regex/". Returns (pattern, targets), with pattern None for
+        the default route and targets None for drop rules.
+    """
+    line = line.strip()
+
+    drop = False
+    if line.startswith("drop "):
+        drop = True
+        line = line[5:].strip()
+
+    if line.startswith("* ") and not drop:
+        return None, parseTargets(line[2:])
+
+    end = line.rfind('/')
+    if not line.startswith('/') or end == 0:
+        raise Exception("Patterns must be enclosed in slashes: /regex/")
+    pattern = line[1:end]
+
+    if drop:
+        if line[end+1:].strip():
+            raise Exception("Drop rules take no channels")
+        return pattern, None
+
+    return pattern, parseTargets(line[end+1:])
+
+def parseTargets(s):
+    targets = tuple(t.strip() for t in s.split(',') if t.strip())
+    if len(targets) == 0:
+        raise Exception("No target channel given")
+    for t in targets:
+        if t[0] not in [ '#', '&' ]:
+            raise Exception("Invalid channel name: " + t)
+    return targets
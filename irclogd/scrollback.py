@@ -0,0 +1,93 @@
+import time
+from collections import deque
+
+class Scrollback:
+    """
+        A ring buffer of the last lines of a channel, bounded by line count
+        and bytes. Lines are kept as serialized PRIVMSG lines, along with the
+        time they were sent.
+    """
+
+    def __init__(self, store, key, maxlines, maxbytes):
+        self.store = store
+        self.key = key
+        self.maxlines = maxlines
+        self.maxbytes = maxbytes
+
+        self.lines = deque()
+        self.size = 0
+
+    def append(self, line):
+        self.lines.append((time.time(), line))
+        self.size += len(line)
+        self.store.size += len(line)
+
+        while len(self.lines) > self.maxlines or self.size > self.maxbytes:
+            self.evict()
+
+        if self.store.size > self.store.maxbytes:
+            self.store.enforce()
+
+    def evict(self):
+        """
+            Drops the oldest line.
+        """
+        n = len(self.lines.popleft()[1])
+        self.size -= n
+        self.store.size -= n
+
+    def replay(self):
+        """
+            Returns all lines as one string, ready to be written. The time
+            each line was sent is inserted in front of its text.
+        """
+        result = [ ]
+        for t, line in self.lines:
+            i = line.find(" :", 1) + 2
+            result.append(line[:i] + time.strftime("[%H:%M:%S] ", time.localtime(t)) + line[i:] + "\r\n")
+        return ''.join(result)
+
+class ScrollbackStore:
+    """
+        Holds the scrollback buffers of all channels in the process, by
+        (nick, channel) so they survive parts and reconnects. If all buffers
+        together exceed maxbytes, lines are evicted from the largest buffers
+        first.
+    """
+
+    def __init__(self, maxbytes = 64*1024*1024):
+        self.maxbytes = maxbytes
+        self.buffers = { }
+        self.size = 0
+
+    def get(self, key, maxlines, maxbytes):
+        """
+            Returns the buffer for key, creating it if necessary. The bounds
+            of an existing buffer are updated.
+        """
+        if key not in self.buffers:
+            self.buffers[key] = Scrollback(self, key, maxlines, maxbytes)
+        buf = self.buffers[key]
+        buf.maxlines = maxlines
+        buf.maxbytes = maxbytes
+        return buf
+
+    def enforce(self):
+        """
+            Evicts lines from the largest buffers, until the store is back at
+            nine tenths of its limit. The slack keeps this from running on
+            every single append.
+        """
+        target = self.maxbytes * 9 / 10
+        while self.size > target:
+            largest = max(self.buffers.itervalues(), key=lambda b: b.size)
+            if len(largest.lines) == 0:
+                break
+            # evict down to the size of the runner-up, or as far as needed
+            floor = max([ b.size for b in self.buffers.itervalues() if b is not largest ] + [ 0 ])
+            largest.evict()
+            while self.size > target and largest.size > floor and len(largest.lines) > 0:
+                largest.evict()
+
+# the process wide store
+store = ScrollbackStore()
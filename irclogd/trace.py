@@ -0,0 +1,148 @@
+"""
+    Protocol tracing. Lines received and sent on the irc connections, lines
+    sent to channels and lines delivered by inputs are kept as plain tuples
+    in a fixed size ring, newest overwriting oldest. Nothing is formatted
+    until the ring is dumped, with the trace channel command or on SIGUSR2,
+    so tracing can stay on all the time.
+"""
+
+import sys
+import time
+import signal
+from time import time as now
+
+from twisted.words.protocols import irc
+from twisted.internet import reactor
+
+import metrics
+
+# what can be traced: lines received from clients, messages sent to them,
+# lines sent to channels and lines delivered by inputs
+categories = ('in', 'out', 'channel', 'input')
+
+class Tracer:
+    """
+        A ring of size records. Of every category, only enabled ones are
+        recorded, and of those only every sample-th event. Recording costs
+        a tuple and a time() call, busy callers check enabled first to save
+        the method call.
+
+        Records are (time, category, fields), with these fields:
+            in: nick, received data
+            out: nick, command, line
+            channel: channel, line
+            input: virtual user, line as read
+    """
+
+    def __init__(self, size = 0, enabled = (), sample = 1):
+        self.setup(size, enabled, sample)
+        # print every record right away, for debugging
+        self.echo = False
+
+    def setup(self, size, enabled, sample):
+        for c in enabled:
+            if c not in categories:
+                raise Exception("Unknown trace category {}, known are {}".format(c, ', '.join(categories)))
+        if sample < 1:
+            raise Exception("Sample must be at least 1")
+        self.ring = [ None ] * size
+        self.size = size
+        self.pos = 0
+        self.enabled = set(enabled) if size > 0 else set()
+        self.sample = sample
+
+        # statistics
+        self.seen = dict((c, 0) for c in categories)
+        self.recorded = 0
+
+    def record(self, category, *fields):
+        if category not in self.enabled:
+            return
+        seen = self.seen
+        n = seen[category] = seen[category] + 1
+        if n % self.sample:
+            return
+        pos = self.pos
+        self.ring[pos] = r = (now(), category, fields)
+        self.pos = pos + 1 if pos + 1 < self.size else 0
+        self.recorded += 1
+        if self.echo:
+            for l in format(r):
+                print l
+
+    def enable(self, enabled):
+        for c in enabled:
+            if c not in categories:
+                raise Exception("Unknown trace category {}, known are {}".format(c, ', '.join(categories)))
+        if len(self.ring) == 0:
+            raise Exception("Tracing is disabled, set tracesize")
+        self.enabled.update(enabled)
+
+    def disable(self, disabled):
+        self.enabled.difference_update(disabled)
+
+    def records(self, n = None, only = None):
+        """
+            Returns the last n records, oldest first, optionally only of the
+            given categories.
+        """
+        records = [ r for r in self.ring[self.pos:] + self.ring[:self.pos]
+                if r is not None and (only is None or r[1] in only) ]
+        return records[-n:] if n is not None else records
+
+    def dump(self, n = None, only = None):
+        """
+            Yields the formatted lines of the last n records.
+        """
+        for r in self.records(n, only):
+            for l in format(r):
+                yield l
+
+    def stats(self):
+        return "trace: {} of {} records, {} sampled 1 in {}, seen {}".format(
+                min(self.recorded, len(self.ring)), len(self.ring),
+                ', '.join(c for c in categories if c in self.enabled) or "nothing", self.sample,
+                ', '.join("{} {}".format(self.seen[c], c) for c in categories))
+
+    def metrics(self):
+        for c in categories:
+            yield "trace_events_total", "counter", { 'category' : c }, self.seen[c]
+        yield "trace_records_total", "counter", { }, self.recorded
+
+def format(r):
+    """
+        Returns the lines of a record, as shown in a dump.
+    """
+    when, category, fields = r
+    # names are unicode, lines are bytes
+    fields = [ f.encode('utf-8') if isinstance(f, unicode) else f for f in fields ]
+    t = time.strftime("%H:%M:%S", time.localtime(when)) + ".{:03d}".format(int(when * 1000) % 1000)
+    if category == 'in':
+        return [ "{} in {}: {}".format(t, fields[0], l) for l in fields[1].splitlines() ]
+    if category == 'out':
+        command = fields[1]
+        if command in irc.numeric_to_symbolic:
+            command = '{}[{}]'.format(command, irc.numeric_to_symbolic[command])
+        return [ "{} out {} {}: {}".format(t, fields[0], command, fields[2]) ]
+    return [ "{} {} {}: {}".format(t, category, fields[0], fields[1]) ]
+
+tracer = Tracer()
+
+def dumpSignal(signum, frame):
+    # dump from the reactor, not from within whatever was interrupted
+    reactor.callFromThread(dumpTo, sys.stderr)
+
+def dumpTo(f):
+    for l in tracer.dump():
+        print >> f, l
+    f.flush()
+
+def install(size, enabled, sample, echo = False):
+    """
+        Sets up the tracer with the categories in enabled, separated by
+        commas, and dumps it to stderr on SIGUSR2.
+    """
+    tracer.setup(size, [ c.strip() for c in enabled.split(',') if c.strip() ], sample)
+    tracer.echo = echo
+    metrics.register(tracer)
+    signal.signal(signal.SIGUSR2, dumpSignal)
@@ -2,7 +2,18 @@ import sys
 
 from twisted.words.protocols import irc
 
-import input.udp, input.fifo
+from input import plugins
+from flood import FloodGateFromParams
+from decode import TemplateFromParams
+from routing import Router, parseRule
+from trace import tracer
+
+def utf8(s):
+    """
+        Returns s as a byte string. Names parsed by twisted are unicode,
+        while lines from the inputs are bytes, and are sent as they are.
+    """
+    return s.encode('utf-8') if isinstance(s, unicode) else s
 
 class PseudoUser:
     """
@@ -20,6 +31,13 @@ class PseudoUser:
         self.name = name
         self.channels = { }
 
+        # encoded ":nick!user@host PRIVMSG #chan :" prefixes, per channel
+        self.prefixcache = None
+        self.prefixindex = None
+
+        # while quiet, notices are not sent
+        self.quiet = False
+
     def cmd(self, line, type = 0):
         """
             Called when a message is sent to the virtual user. This calls the
@@ -54,6 +72,7 @@ class PseudoUser:
 
     def invite(self, channel):
         self.channels[channel.name] = channel
+        self.invalidate()
         channel.registerUser(self)
 
     def leave(self, channel, kick=False):
@@ -68,6 +87,7 @@ class PseudoUser:
         if channel.name not in self.channels:
             return
         del self.channels[channel.name]
+        self.invalidate()
         channel.unregisterUser(self, kick)
 
         # no channels left? destwoy ourself!
@@ -77,10 +97,13 @@ class PseudoUser:
     def msg(self, msg, channel = None):
         """
             This method multicasts a msg to all channels the user is in.
+            The line is quoted once and written against the cached prefix of
+            each channel.
         """
         if channel is None:
-            for name in self.channels:
-                self.channels[name].msg(msg, self.fullname())
+            msg = irc.lowQuote(msg)
+            for channel, prefix in self.prefixes():
+                channel.send(prefix, msg)
             return
 
         # sanity check!
@@ -92,6 +115,8 @@ class PseudoUser:
         """
             This method multicasts a notice to all channels the user is in.
         """
+        if self.quiet:
+            return
         if channel is None:
             for name in self.channels:
                 self.channels[name].notice(msg, self.fullname())
@@ -107,7 +132,39 @@ class PseudoUser:
         self.server.sendMessage(irc.RPL_ENDOFWHO)
 
     def fullname(self):
-        return "{}!{}@{}".format(self.name, "pseudo", self.server.hostname)
+        return "{}!{}@{}".format(utf8(self.name), "pseudo", utf8(self.server.hostname))
+
+    def prefixes(self):
+        """
+            Returns a list of (channel, prefix) tuples, with the serialized
+            PRIVMSG prefix for each channel the user is in. Like the lines,
+            prefixes are byte strings.
+        """
+        if self.prefixcache is None:
+            fullname = self.fullname()
+            self.prefixcache = [ (channel, ":{} PRIVMSG {} :".format(fullname, utf8(name)))
+                    for name, channel in self.channels.iteritems() ]
+            self.prefixindex = dict((channel.name, (channel, prefix)) for channel, prefix in self.prefixcache)
+        return self.prefixcache
+
+    def msgto(self, names, msg):
+        """
+            Sends a msg to the named channels. Channels the user is not in
+            are skipped.
+        """
+        self.prefixes()
+        msg = irc.lowQuote(msg)
+        for name in names:
+            if name in self.prefixindex:
+                channel, prefix = self.prefixindex[name]
+                channel.send(prefix, msg)
+
+    def invalidate(self):
+        """
+            Must be called whenever anything in the prefixes changes: name,
+            input or channels.
+        """
+        self.prefixcache = None
 
     def destroy(self):
         """
@@ -137,23 +194,68 @@ class InputUser(PseudoUser):
 
             > input fifo fifopath
             Listens on a fifo, which must already exist.
-    """
 
-    knownInputs = {
-            'udp' : input.udp.UdpInputFactory,
-            'fifo' : input.fifo.FifoInputFactory,
-        }
+        The modules of the inputs are only imported once they are used, see
+        input.plugins.
+
+        The ratelimit command limits the rate of lines reported from the
+        input, and collapses consecutive identical lines:
+            > ratelimit 50/s burst 200
+
+        The format command shows JSON lines from the input in a readable
+        format:
+            > format json "{level} {service}: {msg}"
+    """
 
     def __init__(self, server, name):
         PseudoUser.__init__(self, server, name)
 
         # no input at the beginning
         self.input = None
+        # and no format, rate limit or routing rules
+        self.template = None
+        self.gate = None
+        self.router = None
+
+        # statistics
+        self.lines = 0
+        self.delivered = 0
+
+    def msg(self, msg, channel = None):
+        """
+            Input lines are formatted, if there is a template, go through the
+            flood gate, if there is one, and are then delivered according to
+            the routing rules.
+        """
+        if channel is None:
+            self.lines += 1
+            if 'input' in tracer.enabled:
+                tracer.record('input', self.name, msg)
+            if self.template is not None:
+                msg = self.template.format(msg)
+            if self.gate is not None:
+                self.gate.msg(msg)
+            else:
+                self.deliver(msg)
+            return
+        PseudoUser.msg(self, msg, channel)
+
+    def deliver(self, msg):
+        """
+            Sends a line to the channels chosen by the routing rules.
+        """
+        self.delivered += 1
+        if self.router is not None:
+            targets = self.router.route(msg)
+            if targets is not None:
+                self.msgto(targets, msg)
+                return
+        PseudoUser.msg(self, msg)
 
     def cmd_input(self, params):
         """
-            Associates this virtual user with an input, using the constructors
-            from the knonwnInputs static variable.
+            Associates this virtual user with an input, found by name in the
+            plugin registry.
 
             If an input is already set, an error is returned.
         """
@@ -161,18 +263,32 @@ class InputUser(PseudoUser):
             self.notice("This user already has an input! Use `reset' to reset it.")
             return
 
-        if params[0] not in InputUser.knownInputs or InputUser.knownInputs[params[0]] is None:
-            self.notice("Unknown or unsupported input: " + params[0])
+        plugindir = getattr(self.server.factory, 'plugindir', None)
+        if len(params) == 0:
+            self.notice("Usage: input <type> [parameters], available are " + ', '.join(plugins.available(plugindir)))
+            return
+        try:
+            plugins.find(params[0], plugindir)
+        except Exception as e:
+            self.notice(str(e))
             return
 
         self.notice("Setting user input to " + params[0])
         try:
-            proto = InputUser.knownInputs[params[0]](self, params[1:])
+            self.setInput(params)
         except Exception as e:
             self.notice("Failed setting input!")
             self.notice("Exception: " + str(e))
-        else:
-            self.input = proto
+
+    def setInput(self, params):
+        """
+            Creates the input described by params and associates it with this
+            user. Raises an Exception if that fails.
+        """
+        proto = plugins.create(self, params, getattr(self.server.factory, 'plugindir', None))
+        self.input = proto
+        self.invalidate()
+        self.server.outq.addInput(proto)
 
     def cmd_reset(self, params):
         """
@@ -183,16 +299,181 @@ class InputUser(PseudoUser):
             return
 
         # make sure this is destroyed
+        self.server.outq.removeInput(self.input)
         self.input.destroy()
         self.notice("Removed {} input..".format(self.input.name))
         self.input = None
+        self.invalidate()
+
+    def cmd_stats(self, params):
+        """
+            Shows statistics of the input, and how many of its lines made it
+            past the rate limit.
+        """
+        if self.input is None:
+            self.notice("There is no input.")
+            return
+
+        for l in self.input.stats():
+            self.notice(l)
+        if self.template is not None:
+            self.notice(self.template.stats())
+        self.notice("{}: {} lines received, {} delivered".format(self.name, self.lines, self.delivered))
+
+    def metrics(self, labels):
+        labels = dict(labels, user=self.name)
+        yield "user_lines_total", "counter", labels, self.lines
+        yield "user_delivered_lines_total", "counter", labels, self.delivered
+        if self.template is not None:
+            yield "user_decoded_lines_total", "counter", labels, self.template.decoded
+            yield "user_undecoded_lines_total", "counter", labels, self.template.raw + self.template.errors
+
+    def cmd_format(self, params):
+        """
+            Shows, sets or removes ("format off") the template for JSON lines
+            from the input.
+        """
+        if len(params) == 0:
+            if self.template is None:
+                self.notice('No format set. Usage: format json "{field} {other.field}..", or format off')
+            else:
+                self.notice("Format: " + str(self.template))
+            return
+
+        if params[0] == "off":
+            self.template = None
+            self.notice("Format removed.")
+            return
+
+        try:
+            self.setFormat(params)
+        except Exception as e:
+            self.notice("Failed setting format: " + str(e))
+        else:
+            self.notice("Format set to " + str(self.template))
+
+    def setFormat(self, params):
+        """
+            Sets the template described by params. Raises an Exception if
+            they are invalid.
+        """
+        self.template = TemplateFromParams(params)
+
+    def cmd_ratelimit(self, params):
+        """
+            Sets or removes ("ratelimit off") the rate limit for lines from
+            the input.
+        """
+        if len(params) == 0:
+            self.notice("Usage: ratelimit rate[/s|/m|/h] [burst n] [window seconds], or ratelimit off")
+            return
+
+        if self.gate is not None:
+            self.gate.stop()
+            self.gate = None
+
+        if params[0] == "off":
+            self.notice("Rate limit removed.")
+            return
+
+        try:
+            self.setRateLimit(params)
+        except Exception as e:
+            self.notice("Failed setting rate limit: " + str(e))
+        else:
+            self.notice("Rate limit set to {:g} lines per second, burst {:g}".format(self.gate.bucket.rate, self.gate.bucket.burst))
+
+    def setRateLimit(self, params):
+        """
+            Sets the rate limit described by params. Raises an Exception if
+            they are invalid.
+        """
+        self.gate = FloodGateFromParams(self.deliver, params)
+
+    def cmd_route(self, params):
+        """
+            Adds a routing rule: route /regex/ &chan[,#chan..], or sets the
+            default channels for unmatched lines: route * &chan[,#chan..]
+        """
+        self.routeCommand(' '.join(params))
+
+    def cmd_drop(self, params):
+        """
+            Adds a rule dropping all lines matching a regex: drop /regex/
+        """
+        self.routeCommand("drop " + ' '.join(params))
+
+    def routeCommand(self, line):
+        try:
+            targets = self.addRoute(line)
+        except Exception as e:
+            self.notice("Failed adding rule: " + str(e))
+            return
+
+        self.notice("Added rule: " + line)
+        missing = [ t for t in targets or () if t not in self.channels ]
+        if missing:
+            self.notice("Not in {}, lines for it are dropped until invited.".format(', '.join(missing)))
+
+    def addRoute(self, line):
+        """
+            Adds a routing rule in the format of routing.parseRule. Returns
+            the targets of the rule, raises an Exception if it is invalid.
+        """
+        pattern, targets = parseRule(line)
+        if self.router is None:
+            self.router = Router()
+        if pattern is None:
+            self.router.default = targets
+        else:
+            self.router.add(pattern, targets)
+        return targets
+
+    def cmd_routes(self, params):
+        """
+            Lists all routing rules, with the number of lines they matched.
+        """
+        if self.router is None:
+            self.notice("No routing rules, all lines go to all channels.")
+            return
+
+        for i, rule in enumerate(self.router.rules):
+            self.notice("{}: {} ({} hits)".format(i, rule, rule.hits))
+        self.notice("*: {} ({} hits)".format(','.join(self.router.default) if self.router.default else "all channels", self.router.unmatched))
+
+    def cmd_unroute(self, params):
+        """
+            Removes a routing rule by its number from the routes list, the
+            default with "unroute *", or all rules with "unroute all".
+        """
+        if self.router is None or len(params) == 0:
+            self.notice("Usage: unroute <number>|*|all, see routes for the numbers")
+            return
+
+        if params[0] == "all":
+            self.router = None
+            self.notice("Removed all rules.")
+            return
+
+        if params[0] == "*":
+            self.router.default = None
+        else:
+            try:
+                self.router.remove(int(params[0]))
+            except (ValueError, IndexError):
+                self.notice("No such rule: " + params[0])
+                return
+
+        self.notice("Removed rule " + params[0])
+        if len(self.router.rules) == 0 and self.router.default is None:
+            self.router = None
 
     def who(self):
         self.server.sendMessage(irc.RPL_WHOREPLY, self.channels.keys()[0], "input/none" if self.input is None else "input/{}".format(self.input.name), self.server.hostname, self.server.hostname, self.name, "H", "1 {}".format("InputUser"))
         self.server.sendMessage(irc.RPL_ENDOFWHO)
 
     def fullname(self):
-        return "{}!{}@{}".format(self.name, "input/none" if self.input is None else "input/{}".format(self.input.name), self.server.hostname)
+        return "{}!{}@{}".format(utf8(self.name), "input/none" if self.input is None else "input/{}".format(self.input.name), utf8(self.server.hostname))
 
     def destroy(self):
         """
@@ -200,7 +481,12 @@ class InputUser(PseudoUser):
         """
 
         if self.input is not None:
+            self.server.outq.removeInput(self.input)
             self.input.destroy()
 
+        if self.gate is not None:
+            self.gate.stop()
+            self.gate = None
+
         PseudoUser.destroy(self)
 
@@ -57,14 +57,21 @@ class FIFOFileDescriptor(FileDescriptor):
 class FIFOReader(FIFOFileDescriptor):
     """
     A reading end of a FIFO.
+
+    @ivar budget: Bytes read at most per reactor iteration, None for all
+        there is. If the budget is spent, the protocol's C{exhausted} method
+        is called, if it has one, and the rest is read in the next iteration.
     """
     chunk_size = 8192
+    budget = None
+    reading = False
     implements(interfaces.IReadDescriptor)
 
     def startReading(self):
         """
         Start waiting for read availability
         """
+        self.reading = True
         if self.connected:
             FileDescriptor.startReading(self)
             return
@@ -72,6 +79,13 @@ class FIFOReader(FIFOFileDescriptor):
         self.connected = 1
         FileDescriptor.startReading(self)
 
+    def stopReading(self):
+        """
+        Stop waiting for read availability, also in the middle of a read
+        """
+        self.reading = False
+        FileDescriptor.stopReading(self)
+
     def startWriting(self):
         """
         Since this is a reader, it can not write to the FIFO
@@ -83,7 +97,13 @@ class FIFOReader(FIFOFileDescriptor):
         """
         Data is available for reading on this FIFO
         """
-        while True:
+        read = 0
+        while self.reading:
+            if self.budget is not None and read >= self.budget:
+                exhausted = getattr(self.protocol, 'exhausted', None)
+                if exhausted is not None:
+                    exhausted()
+                return
             try:
                 output = os.read(self.fileno(), self.chunk_size)
             except (OSError, IOError), err:
@@ -93,6 +113,7 @@ class FIFOReader(FIFOFileDescriptor):
                     return main.CONNECTION_LOST
             if not output:
                 return main.CONNECTION_DONE
+            read += len(output)
             self.protocol.dataReceived(output)
 
     def loseConnection(self, _connDone=failure.Failure(main.CONNECTION_DONE)):